@@ -0,0 +1,569 @@
+"""
+Benchmark and meta test suite of DiscoverRoadRunner.
+
+Generates a synthetic Django project, runs its tests with Django's own
+DiscoverRunner and then DiscoverRoadRunner (cold, then reusing its stored
+databases), checks they all agree on the results, and compares how long
+each phase took against a stored baseline, e.g. ::
+
+    python -m discover_road_runner.benchmark --apps=20 --tests=30
+    python -m discover_road_runner.benchmark --baseline=bench.json --save
+    python -m discover_road_runner.benchmark --baseline=bench.json
+
+Exits with status 1 if the results differ, or anything got slower than the
+baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+DISCOVER_RUNNER = 'django.test.runner.DiscoverRunner'
+ROAD_RUNNER = 'discover_road_runner.runners.DiscoverRoadRunner'
+
+# Phases of --phase-timings, in the order they happen
+PHASES = ('discover', 'migrate', 'dump', 'clone', 'run', 'collect')
+
+# Results compared between the runners
+RESULT_KEYS = (
+    'run', 'failures', 'errors', 'skipped',
+    'expected_failures', 'unexpected_successes',
+)
+
+# Slower than the baseline by less than this many seconds is just noise
+MIN_REGRESSION_SECONDS = 0.2
+
+MANAGE_PY = '''\
+#!/usr/bin/env python
+import os
+import sys
+
+if __name__ == "__main__":
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bench_settings")
+
+    from django.core.management import execute_from_command_line
+
+    execute_from_command_line(sys.argv)
+'''
+
+SETTINGS = '''\
+SECRET_KEY = 'benchmark'
+INSTALLED_APPS = {installed_apps!r}
+MIDDLEWARE_CLASSES = ()
+DATABASES = {{
+    'default': {{
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }},
+    'other': {{
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }},
+}}
+USE_TZ = True
+LOCAL_CACHE = 'local_cache'
+TEST_RUNNER_SKIP_DB_FOR_SIMPLE_TESTS = True
+'''
+
+MODELS = '''\
+from django.db import models
+
+
+class Item(models.Model):
+    name = models.CharField(max_length=100)
+{value_fields}'''
+
+VALUE_FIELD = '''\
+    value_{number} = models.IntegerField(default=0)
+'''
+
+INITIAL_MIGRATION = '''\
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name='Item',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+            ],
+        ),
+    ]
+'''
+
+VALUE_MIGRATION = '''\
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [({app_label!r}, {previous!r})]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='value_{number}',
+            field=models.IntegerField(default=0),
+        ),
+    ]
+'''
+
+TESTS_HEADER = '''\
+import time
+import unittest
+
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from {app_label}.models import Item
+'''
+
+SIMPLE_TESTS = '''
+
+class SimpleTest(SimpleTestCase):
+'''
+
+SIMPLE_TEST = '''
+    def test_simple_{number}(self):
+        time.sleep({sleep})
+        self.assertEqual(sum(range({number})), {total})
+'''
+
+FIXTURE_TESTS = '''
+
+class FixtureTest(TestCase):
+    fixtures = [{fixture!r}]
+'''
+
+FIXTURE_TEST = '''
+    def test_fixture_{number}(self):
+        time.sleep({sleep})
+        Item.objects.create(name='new')
+        self.assertEqual(Item.objects.count(), {rows} + 1)
+'''
+
+TRANSACTION_TESTS = '''
+
+class TransactionTest(TransactionTestCase):
+'''
+
+TRANSACTION_TEST = '''
+    def test_transaction_{number}(self):
+        time.sleep({sleep})
+        Item.objects.create(name='new')
+        self.assertEqual(Item.objects.count(), 1)
+'''
+
+# In the last app only. A TestCase only rolls back the default database,
+# so what it leaves in the other one mustn't be seen by the
+# OtherDatabaseTest of any app run after it, which DiscoverRunner doesn't
+# as it runs them first. Slowest, so DiscoverRoadRunner runs it first once
+# it has timings.
+LEAKING_TESTS = '''
+
+class LeakingTest(TestCase):
+
+    def test_leak_into_other_database(self):
+        time.sleep(0.2)
+        Item.objects.using('other').create(name='leaked')
+'''
+
+# In every other app
+OTHER_DATABASE_TESTS = '''
+
+class OtherDatabaseTest(TestCase):
+
+    def test_other_database_is_empty(self):
+        from {last_app_label}.models import Item as LastItem
+        self.assertFalse(LastItem.objects.using('other').exists())
+'''
+
+# In the first app only, so the results compared include them
+OUTCOME_TESTS = '''
+
+class OutcomeTest(SimpleTestCase):
+
+    def test_failure(self):
+        self.fail('Deliberate, for the benchmark to compare')
+
+    def test_error(self):
+        raise ValueError('Deliberate, for the benchmark to compare')
+
+    @unittest.skip('Deliberate, for the benchmark to compare')
+    def test_skip(self):
+        pass
+'''
+
+
+def write_file(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as outfile:
+        outfile.write(content)
+
+
+def generate_app(project_dir, app_label, options, app_labels):
+    """
+    An app with an Item model built up by --migrations migrations,
+    a fixture of --fixture-rows of them and --tests tests, mostly
+    TestCases using the fixture.
+    """
+    app_dir = os.path.join(project_dir, app_label)
+    write_file(os.path.join(app_dir, '__init__.py'), '')
+    write_file(os.path.join(app_dir, 'models.py'), MODELS.format(
+        value_fields=''.join(
+            VALUE_FIELD.format(number=number)
+            for number in range(1, options.migrations)
+        )))
+
+    migrations_dir = os.path.join(app_dir, 'migrations')
+    write_file(os.path.join(migrations_dir, '__init__.py'), '')
+    previous = '0001_initial'
+    write_file(
+        os.path.join(migrations_dir, previous + '.py'), INITIAL_MIGRATION)
+    for number in range(1, options.migrations):
+        name = '{:04d}_value_{}'.format(number + 1, number)
+        write_file(os.path.join(migrations_dir, name + '.py'),
+                   VALUE_MIGRATION.format(
+                       app_label=app_label, previous=previous, number=number))
+        previous = name
+
+    fixture = app_label + '.json'
+    write_file(os.path.join(app_dir, 'fixtures', fixture), json.dumps([
+        {
+            'model': '{}.item'.format(app_label),
+            'pk': pk,
+            'fields': {'name': 'Item {}'.format(pk)},
+        }
+        for pk in range(1, options.fixture_rows + 1)
+    ], indent=2))
+
+    simple_count = int(options.tests * options.simple_share)
+    transaction_count = int(options.tests * options.transaction_share)
+    fixture_count = max(options.tests - simple_count - transaction_count, 0)
+    parts = [TESTS_HEADER.format(app_label=app_label)]
+    for header, template, count in (
+            (SIMPLE_TESTS, SIMPLE_TEST, simple_count),
+            (FIXTURE_TESTS, FIXTURE_TEST, fixture_count),
+            (TRANSACTION_TESTS, TRANSACTION_TEST, transaction_count)):
+        if not count:
+            continue
+        parts.append(header.format(fixture=fixture))
+        parts.extend(
+            template.format(
+                number=number, sleep=options.sleep,
+                total=sum(range(number)), rows=options.fixture_rows)
+            for number in range(count)
+        )
+    if app_label == app_labels[0]:
+        parts.append(OUTCOME_TESTS)
+    if app_label == app_labels[-1]:
+        parts.append(LEAKING_TESTS)
+    else:
+        parts.append(OTHER_DATABASE_TESTS.format(
+            last_app_label=app_labels[-1]))
+    write_file(os.path.join(app_dir, 'tests.py'), ''.join(parts))
+
+
+def get_app_labels(options):
+    return ['bench_app_{}'.format(i) for i in range(options.apps)]
+
+
+def generate_project(project_dir, options):
+    """
+    A Django project of --apps generated apps, in project_dir.
+    """
+    app_labels = get_app_labels(options)
+    write_file(os.path.join(project_dir, 'manage.py'), MANAGE_PY)
+    write_file(os.path.join(project_dir, 'bench_settings.py'),
+               SETTINGS.format(installed_apps=tuple(app_labels)))
+    for app_label in app_labels:
+        generate_app(project_dir, app_label, options, app_labels)
+
+
+def run_manage_test(project_dir, runner, args):
+    """
+    Runs `manage.py test` with the given test runner in a fresh process,
+    returning how long it took and its output.
+    """
+    env = dict(os.environ)
+    # So the generated project can use this discover_road_runner
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in (package_root, env.get('PYTHONPATH')) if path)
+    command = [
+        sys.executable, 'manage.py', 'test', '--testrunner=' + runner,
+    ] + args
+    start = time.time()
+    process = subprocess.Popen(
+        command, cwd=project_dir, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0].decode('utf-8', 'replace')
+    return time.time() - start, output
+
+
+def parse_discover_runner_output(output):
+    """
+    The results of a DiscoverRunner run, from what it printed, in the same
+    shape as the results of DiscoverRoadRunner's --phase-timings.
+    """
+    results = dict.fromkeys(RESULT_KEYS, 0)
+    ran = re.search(r'^Ran (\d+) tests? in', output, re.M)
+    if ran is None:
+        raise ValueError('DiscoverRunner did not run:\n' + output)
+    results['run'] = int(ran.group(1))
+    outcome = re.search(r'^(?:OK|FAILED) \((.*)\)$', output, re.M)
+    if outcome:
+        for count in outcome.group(1).split(', '):
+            name, _, number = count.partition('=')
+            results[name.replace(' ', '_')] = int(number)
+    failed_tests = set()
+    for method, location in re.findall(
+            r'^(?:FAIL|ERROR): (\S+) \((\S+)\)$', output, re.M):
+        if location.endswith('.' + method):
+            # Python 3.11+ gives the whole dotted path
+            failed_tests.add(location)
+        elif method in ('setUpClass', 'tearDownClass', 'setUpModule',
+                        'tearDownModule'):
+            failed_tests.add(location)
+        else:
+            failed_tests.add('{}.{}'.format(location, method))
+    results['failed_tests'] = sorted(failed_tests)
+    return results
+
+
+def run_road_runner(project_dir, args):
+    """
+    Runs DiscoverRoadRunner, returning its --phase-timings.
+    """
+    phase_timings_path = os.path.join(project_dir, 'phase_timings.json')
+    if os.path.exists(phase_timings_path):
+        os.remove(phase_timings_path)
+    took, output = run_manage_test(
+        project_dir, ROAD_RUNNER,
+        ['--phase-timings=' + phase_timings_path] + args)
+    if not os.path.exists(phase_timings_path):
+        raise ValueError('DiscoverRoadRunner did not finish:\n' + output)
+    with open(phase_timings_path) as infile:
+        phase_timings = json.load(infile)
+    phase_timings['wall'] = took
+    phase_timings['output'] = output
+    return phase_timings
+
+
+def fastest(runs):
+    """
+    The run that took the least wall time out of several.
+    """
+    return min(runs, key=lambda run: run['wall'])
+
+
+def benchmark(project_dir, options):
+    """
+    {scenario: {'wall': seconds, 'phases': ..., 'results': ...}} of
+    DiscoverRunner, then DiscoverRoadRunner without any stored databases or
+    timings (cold) and with them (warm), each the fastest of --repeat runs.
+    """
+    road_runner_args = ['--concurrency={}'.format(options.concurrency)]
+    road_runner_args += shlex.split(options.runner_args)
+    discover_runs = []
+    for _ in range(options.repeat):
+        # In app order, which discovery doesn't keep on Python 2
+        took, output = run_manage_test(
+            project_dir, DISCOVER_RUNNER, get_app_labels(options))
+        discover_runs.append({
+            'wall': took,
+            'phases': {},
+            'results': parse_discover_runner_output(output),
+        })
+    local_cache = os.path.join(project_dir, 'local_cache')
+    cold_runs = []
+    for _ in range(options.repeat):
+        if os.path.exists(local_cache):
+            shutil.rmtree(local_cache)
+        cold_runs.append(run_road_runner(project_dir, road_runner_args))
+    warm_runs = [
+        run_road_runner(project_dir, road_runner_args)
+        for _ in range(options.repeat)
+    ]
+    return {
+        'discover_runner': fastest(discover_runs),
+        'road_runner_cold': fastest(cold_runs),
+        'road_runner_warm': fastest(warm_runs),
+    }
+
+
+def compare_results(results, expected):
+    """
+    Differences between the results of a DiscoverRoadRunner scenario and
+    those of DiscoverRunner, as messages.
+    """
+    return [
+        '{}: {} but DiscoverRunner {}'.format(
+            key, results.get(key), expected.get(key))
+        for key in RESULT_KEYS + ('failed_tests',)
+        if results.get(key) != expected.get(key)
+    ]
+
+
+def scenario_timings(measured):
+    """
+    {'scenario phase': seconds} of everything timed, to store as a baseline.
+    """
+    timings = {}
+    for scenario, run in measured.items():
+        timings[scenario + ' wall'] = run['wall']
+        for phase, took in run['phases'].items():
+            timings['{} {}'.format(scenario, phase)] = took
+    return timings
+
+
+def find_regressions(timings, baseline, tolerance):
+    """
+    Whatever took longer than in the baseline by more than tolerance
+    (a fraction) and MIN_REGRESSION_SECONDS, as messages.
+    """
+    regressions = []
+    for name, took in sorted(timings.items()):
+        if name not in baseline:
+            continue
+        allowed = max(baseline[name] * (1 + tolerance),
+                      baseline[name] + MIN_REGRESSION_SECONDS)
+        if took > allowed:
+            regressions.append('{}: {:.3f}s, baseline {:.3f}s'.format(
+                name, took, baseline[name]))
+    return regressions
+
+
+def build_report(measured):
+    """
+    Table of the phases of each DiscoverRoadRunner scenario, and the
+    wall time of every scenario.
+    """
+    cold = measured['road_runner_cold']
+    warm = measured['road_runner_warm']
+    lines = ['{:10} {:>10} {:>10}'.format('Phase', 'cold', 'warm')]
+    for phase in PHASES:
+        lines.append('{:10} {:>9.3f}s {:>9.3f}s'.format(
+            phase, cold['phases'].get(phase, 0), warm['phases'].get(phase, 0)))
+    lines.append('{:10} {:>9.3f}s {:>9.3f}s'.format(
+        'wall', cold['wall'], warm['wall']))
+    discover_wall = measured['discover_runner']['wall']
+    lines.append('DiscoverRunner wall {:.3f}s, {:.1f}x DiscoverRoadRunner '
+                 'warm'.format(discover_wall, discover_wall / warm['wall']))
+    return '\n'.join(lines)
+
+
+def get_scenario_name(options):
+    """
+    What the baseline of these options is stored under.
+    """
+    return ('apps={0.apps} tests={0.tests} migrations={0.migrations} '
+            'fixture_rows={0.fixture_rows} sleep={0.sleep} '
+            'concurrency={0.concurrency} runner_args={0.runner_args}'
+            .format(options))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark DiscoverRoadRunner against DiscoverRunner '
+                    'on a generated Django project.')
+    parser.add_argument('--apps', type=int, default=10)
+    parser.add_argument('--tests', type=int, default=20,
+                        help='Tests per app.')
+    parser.add_argument('--migrations', type=int, default=5,
+                        help='Migrations per app.')
+    parser.add_argument('--fixture-rows', type=int, default=50,
+                        help='Rows in the fixture of each app.')
+    parser.add_argument('--simple-share', type=float, default=0.3,
+                        help='Share of the tests that are SimpleTestCases.')
+    parser.add_argument('--transaction-share', type=float, default=0.1,
+                        help='Share of the tests that are '
+                             'TransactionTestCases, the rest are TestCases '
+                             'loading the fixture.')
+    parser.add_argument('--sleep', type=float, default=0,
+                        help='Seconds every test sleeps for.')
+    parser.add_argument('--concurrency', default='auto',
+                        help='--concurrency of DiscoverRoadRunner.')
+    parser.add_argument('--runner-args', default='',
+                        help='Any other DiscoverRoadRunner options, '
+                             'e.g. "--split=class --file-db".')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Keep the fastest of this many runs of each.')
+    parser.add_argument('--baseline', default='',
+                        help='JSON file of stored timings to compare with.')
+    parser.add_argument('--save', action='store_true',
+                        help='Store these timings in --baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='How much slower than the baseline (0.2 is '
+                             '20%%) counts as a regression.')
+    parser.add_argument('--project-dir', default='',
+                        help='Generate the project here and keep it, '
+                             'rather than in a temporary directory.')
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    project_dir = options.project_dir or tempfile.mkdtemp(
+        prefix='road_runner_benchmark_')
+    try:
+        generate_project(project_dir, options)
+        measured = benchmark(project_dir, options)
+    finally:
+        if not options.project_dir:
+            shutil.rmtree(project_dir)
+
+    print(build_report(measured))
+    failed = False
+    for scenario in ('road_runner_cold', 'road_runner_warm'):
+        differences = compare_results(
+            measured[scenario]['results'],
+            measured['discover_runner']['results'])
+        if not differences:
+            continue
+        failed = True
+        # What went wrong is usually in there, e.g. a process that died
+        print('Output of DiscoverRoadRunner {}:\n{}'.format(
+            scenario, measured[scenario]['output']))
+        for difference in differences:
+            print('Results differ, {} {}'.format(scenario, difference))
+
+    if options.baseline:
+        scenario = get_scenario_name(options)
+        timings = scenario_timings(measured)
+        baselines = {}
+        if os.path.exists(options.baseline):
+            with open(options.baseline) as infile:
+                baselines = json.load(infile)
+        if options.save:
+            baselines[scenario] = timings
+            with open(options.baseline, 'w') as outfile:
+                json.dump(baselines, outfile, indent=2, sort_keys=True)
+            print('Baseline stored in {}'.format(options.baseline))
+        elif scenario not in baselines:
+            print('No baseline for {} in {}, store one with --save'.format(
+                scenario, options.baseline))
+        else:
+            for regression in find_regressions(
+                    timings, baselines[scenario], options.tolerance):
+                print('Slower than the baseline, ' + regression)
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+The source_queue and result_queue of a --coordinator served over TCP,
+so --agent processes on any machine (this one included) can pull
+test_labels from it and push their results back.
+"""
+import sys
+import threading
+from multiprocessing.managers import BaseManager
+
+if sys.version_info[0] >= 3:
+    from queue import Queue
+else:
+    from Queue import Queue
+
+
+def parse_address(address):
+    """
+    (host, port) from a host:port string.
+    """
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError('Expected host:port, not {!r}'.format(address))
+    return host, int(port)
+
+
+def serve_queues(address, authkey, wants_events=False):
+    """
+    Serves a new source_queue and result_queue at address, in a background
+    thread, along with an Event to set once there is nothing left to run
+    and one set if the per-test events are wanted (--jsonl, --junit-xml).
+    """
+    source_queue = Queue()
+    result_queue = Queue()
+    finished = threading.Event()
+    events_wanted = threading.Event()
+    if wants_events:
+        events_wanted.set()
+
+    # A class per call, as register() changes the class
+    class CoordinatorManager(BaseManager):
+        pass
+
+    CoordinatorManager.register('get_source_queue', lambda: source_queue)
+    CoordinatorManager.register('get_result_queue', lambda: result_queue)
+    CoordinatorManager.register('get_finished', lambda: finished)
+    CoordinatorManager.register('get_events_wanted', lambda: events_wanted)
+    server = CoordinatorManager(address, authkey).get_server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return source_queue, result_queue, finished
+
+
+def connect_queues(address, authkey):
+    """
+    Proxies of the source_queue, result_queue, finished Event and
+    events_wanted Event served at address by serve_queues.
+    """
+
+    class AgentManager(BaseManager):
+        pass
+
+    for name in ('get_source_queue', 'get_result_queue', 'get_finished',
+                 'get_events_wanted'):
+        AgentManager.register(name)
+    manager = AgentManager(address, authkey)
+    manager.connect()
+    return (
+        manager.get_source_queue(),
+        manager.get_result_queue(),
+        manager.get_finished(),
+        manager.get_events_wanted(),
+    )
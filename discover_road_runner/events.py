@@ -0,0 +1,106 @@
+"""
+Per-test events from every process, written out as soon as they arrive,
+as JSON lines and/or JUnit XML, so CI can follow a run that is still going
+and a run that gets killed still leaves the results it got to.
+"""
+import json
+import os
+import re
+from xml.etree import ElementTree
+
+# Not allowed in XML 1.0, even escaped, but can turn up in tracebacks
+INVALID_XML_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Test outcomes, and the JUnit XML element each is reported as, if any
+JUNIT_ELEMENTS = {
+    'success': None,
+    'expected_failure': None,
+    'unexpected_success': 'failure',
+    'failure': 'failure',
+    'error': 'error',
+    'skipped': 'skipped',
+}
+
+
+class TestEventLog(object):
+    """
+    Writes each 'start' and 'stop' event of an individual test to
+    --jsonl straight away, and rewrites --junit-xml with every test
+    stopped so far whenever save_junit_xml is called.
+    """
+
+    def __init__(self, jsonl_path='', junit_xml_path=''):
+        self.jsonl_file = open(jsonl_path, 'w') if jsonl_path else None
+        self.junit_xml_path = junit_xml_path
+        self.stopped = []
+
+    def add(self, event):
+        if self.jsonl_file is not None:
+            self.jsonl_file.write(json.dumps(event, sort_keys=True) + '\n')
+            self.jsonl_file.flush()
+        if event['event'] == 'stop':
+            self.stopped.append(event)
+
+    def save_junit_xml(self):
+        if not self.junit_xml_path:
+            return
+        tmp_path = self.junit_xml_path + '.tmp'
+        build_junit_xml(self.stopped).write(
+            tmp_path, encoding='utf-8', xml_declaration=True)
+        # Never leave a half written file behind for CI to choke on
+        os.rename(tmp_path, self.junit_xml_path)
+
+    def close(self):
+        self.save_junit_xml()
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+            self.jsonl_file = None
+
+
+def build_junit_xml(stopped):
+    """
+    ElementTree of a <testsuites> with a <testsuite> per test_label,
+    from the 'stop' events of the tests run.
+    """
+    root = ElementTree.Element('testsuites')
+    suites = {}
+    for event in stopped:
+        test_label = event['test_label']
+        if test_label not in suites:
+            suites[test_label] = ElementTree.SubElement(
+                root, 'testsuite', name=test_label)
+        class_name, _, name = event['test_id'].rpartition('.')
+        testcase = ElementTree.SubElement(
+            suites[test_label], 'testcase',
+            classname=class_name, name=name,
+            time='{:.3f}'.format(event['took']),
+        )
+        element_name = JUNIT_ELEMENTS[event['outcome']]
+        if element_name is not None:
+            details = INVALID_XML_CHARS.sub('', event['details'])
+            element = ElementTree.SubElement(
+                testcase, element_name,
+                message=details.strip().split('\n')[-1][:200],
+            )
+            element.text = details
+    for element in [root] + list(suites.values()):
+        set_counts(element, list(element.iter('testcase')))
+    return ElementTree.ElementTree(root)
+
+
+def set_counts(element, testcases):
+    """
+    The tests, failures, errors, skipped and time attributes of a
+    <testsuite> or <testsuites>.
+    """
+    counts = dict.fromkeys(('failure', 'error', 'skipped'), 0)
+    took = 0.0
+    for testcase in testcases:
+        took += float(testcase.get('time'))
+        for child in testcase:
+            counts[child.tag] += 1
+    element.set('tests', str(len(testcases)))
+    element.set('failures', str(counts['failure']))
+    element.set('errors', str(counts['error']))
+    element.set('skipped', str(counts['skipped']))
+    element.set('time', '{:.3f}'.format(took))
@@ -0,0 +1,187 @@
+"""
+Static import graph of a project's own Python source, so the test_labels a
+change can affect are known without importing (or running) anything.
+Dynamic imports, e.g. INSTALLED_APPS or ROOT_URLCONF strings, are not seen.
+"""
+import ast
+import os
+
+# Never project source, and can be huge
+SKIP_DIRS = ('__pycache__', 'node_modules', 'site-packages')
+
+
+def walk_project(root, exclude_dirs=()):
+    """
+    Absolute path of every file under root, skipping hidden directories,
+    virtualenvs and the like.
+    """
+    exclude_dirs = set(os.path.abspath(d) for d in exclude_dirs)
+    for dir_path, dir_names, file_names in os.walk(os.path.abspath(root)):
+        dir_names[:] = [
+            name for name in dir_names
+            if not name.startswith('.') and
+            name not in SKIP_DIRS and
+            os.path.join(dir_path, name) not in exclude_dirs and
+            # virtualenvs
+            not os.path.exists(os.path.join(dir_path, name, 'pyvenv.cfg'))
+        ]
+        for file_name in file_names:
+            yield os.path.join(dir_path, file_name)
+
+
+def find_modules(root, exclude_dirs=()):
+    """
+    {dotted module name: absolute path} of every .py file under root.
+    """
+    return dict(
+        (module_name(root, path), path)
+        for path in walk_project(root, exclude_dirs)
+        if path.endswith('.py')
+    )
+
+
+def file_mtimes(root, exclude_dirs=()):
+    """
+    {absolute path: modification time} of every file under root,
+    to compare against later to see what changed.
+    """
+    mtimes = {}
+    for path in walk_project(root, exclude_dirs):
+        if path.endswith(('.pyc', '.pyo')):
+            # Written by running the tests, not by changing anything
+            continue
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            # Deleted since listing it
+            pass
+    return mtimes
+
+
+def module_name(root, path):
+    """
+    Dotted module name of a .py file, relative to root
+    e.g. pkg/app/tests.py -> pkg.app.tests and pkg/app/__init__.py -> pkg.app
+    """
+    rel_path = os.path.splitext(os.path.relpath(path, root))[0]
+    parts = rel_path.split(os.sep)
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join(parts)
+
+
+def imported_names(path, name):
+    """
+    Every dotted name the module at path imports, including the
+    `from package import module` kind that may or may not be modules.
+    """
+    with open(path, 'rb') as infile:
+        try:
+            tree = ast.parse(infile.read(), path)
+        except (SyntaxError, ValueError):
+            return set()
+    if os.path.basename(path) == '__init__.py':
+        package = name
+    else:
+        package = name.rpartition('.')[0]
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                # Relative import
+                parts = package.split('.') if package else []
+                parts = parts[:len(parts) - (node.level - 1)]
+                base = '.'.join(p for p in parts + [base] if p)
+            if base:
+                names.add(base)
+            names.update(
+                '.'.join((base, alias.name)) if base else alias.name
+                for alias in node.names
+            )
+    return names
+
+
+def build_import_graph(modules):
+    """
+    {module: set of project modules it imports}. Importing a.b.c also
+    runs a and a.b, so those count as imported too.
+    """
+    graph = {}
+    for name, path in modules.items():
+        imports = set()
+        for imported in imported_names(path, name):
+            parts = imported.split('.')
+            for i in range(1, len(parts) + 1):
+                prefix = '.'.join(parts[:i])
+                if prefix in modules and prefix != name:
+                    imports.add(prefix)
+        graph[name] = imports
+    return graph
+
+
+def dependents(graph, changed_modules):
+    """
+    The changed modules, plus every module that imports any of them,
+    directly or indirectly.
+    """
+    imported_by = {}
+    for name, imports in graph.items():
+        for imported in imports:
+            imported_by.setdefault(imported, set()).add(name)
+    affected = set(changed_modules)
+    todo = list(changed_modules)
+    while todo:
+        for name in imported_by.get(todo.pop(), ()):
+            if name not in affected:
+                affected.add(name)
+                todo.append(name)
+    return affected
+
+
+def label_matches(test_label, name):
+    """
+    Whether a test_label (app, module, TestCase or test method dotted path)
+    and a module name overlap, i.e. one is inside the other.
+    """
+    return (
+        test_label == name or
+        name.startswith(test_label + '.') or
+        test_label.startswith(name + '.')
+    )
+
+
+def affected_labels(test_labels, changed_files, root, exclude_dirs=()):
+    """
+    The test_labels whose modules import, directly or indirectly,
+    a changed .py file, or that contain any changed file at all
+    (fixtures, templates, ...).
+    """
+    modules = find_modules(root, exclude_dirs)
+    graph = build_import_graph(modules)
+    changed_files = [os.path.abspath(path) for path in changed_files]
+    root = os.path.abspath(root)
+    changed_modules = set(
+        module_name(root, path)
+        for path in changed_files
+        if path.endswith('.py') and path.startswith(root + os.sep)
+    )
+    affected = dependents(graph, changed_modules)
+    # Directories of the packages test_labels can point into
+    package_dirs = dict(
+        (name, os.path.dirname(path))
+        for name, path in modules.items()
+        if os.path.basename(path) == '__init__.py'
+    )
+    result = []
+    for test_label in test_labels:
+        if any(label_matches(test_label, name) for name in affected):
+            result.append(test_label)
+            continue
+        label_dir = package_dirs.get(test_label)
+        if label_dir and any(
+                path.startswith(label_dir + os.sep) for path in changed_files):
+            result.append(test_label)
+    return result
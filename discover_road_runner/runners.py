@@ -1,4 +1,17 @@
+import cProfile
+import functools
+import glob
+import hashlib
+import importlib
+import json
+import math
+import mmap
 import os
+import pstats
+import re
+import shutil
+import socket
+import sqlite3
 import subprocess
 import sys
 
@@ -10,13 +23,15 @@ else:
 
 import time
 import unittest
-from multiprocessing import Process, Queue
+from collections import OrderedDict
+from multiprocessing import Process, Queue, current_process
 from optparse import make_option
 
 from billiard import cpu_count
 from django import VERSION as DJANGO_VERSION
 from django.conf import settings
-from django.db import connections
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
 
 if DJANGO_VERSION[1] >= 8:
     from django.db.backends.base.base import BaseDatabaseWrapper
@@ -24,9 +39,33 @@ else:
     from django.db.backends import BaseDatabaseWrapper
 
 from django.db.models import get_apps
+from django.test import TestCase, TransactionTestCase
 from django.test.runner import DiscoverRunner, dependency_ordered
 from termcolor import colored
 
+from discover_road_runner.coordinator import (
+    connect_queues, parse_address, serve_queues,
+)
+from discover_road_runner.events import TestEventLog
+from discover_road_runner.import_graph import (
+    affected_labels, build_import_graph, dependents, file_mtimes, find_modules,
+    label_matches, module_name,
+)
+
+# File formats --ramdb databases can be stored in, the first is the default.
+# sqlite3 is a real database image, sql a (slower to load) text dump.
+RAMDB_FORMATS = ('sqlite3', 'sql')
+
+# Units that --split breaks oversized test_labels into
+SPLIT_CHOICES = ('module', 'class')
+
+MEGABYTE = 1024.0 * 1024
+
+# Linux ioctl sharing one file's blocks with another, copy-on-write
+FICLONE = 0x40049409
+# Bytes at a time, when that isn't supported and --file-db has to copy
+CLONE_CHUNK_SIZE = 1024 * 1024
+
 
 class DiscoverRoadRunner(DiscoverRunner):
 
@@ -38,13 +77,163 @@ class DiscoverRoadRunner(DiscoverRunner):
             action='store', dest='concurrency', default=None,
             help='Number of additional parallel processes to run. '
                  '--concurrency=0 is thus special - it means run in the '
-                 'same Python process.',
+                 'same Python process. --concurrency=auto picks (and '
+                 'adjusts) it from the idle cores, available memory and '
+                 'the memory and durations of previous runs.',
         )
         parser.add_argument(
             '-m', '--ramdb', action='store', dest='ramdb', default='',
             help='Preserve the :memory:, '
                  'or RAM test database between runs.'
         )
+        parser.add_argument(
+            '--ramdb-format', action='store', dest='ramdb_format',
+            default=RAMDB_FORMATS[0], choices=RAMDB_FORMATS,
+            help='Store --ramdb databases as a sqlite3 database image '
+                 '(fastest to load) or as a sql text dump.'
+        )
+        parser.add_argument(
+            '--file-db', action='store_true', dest='file_db', default=False,
+            help='Give each process its own file backed copy of the stored '
+                 'SQLite databases rather than a :memory: one, cloned '
+                 'copy-on-write where the filesystem supports it.'
+        )
+        parser.add_argument(
+            '--coverage', action='store_true', dest='coverage',
+            default=False,
+            help='Measure code coverage in every process, combining it all '
+                 'into one coverage data file at the end.'
+        )
+        parser.add_argument(
+            '--changed-since', action='store', dest='changed_since',
+            default='',
+            help='Only run the test_labels affected by changes (committed or '
+                 'not) since this git or hg revision.'
+        )
+        parser.add_argument(
+            '--failed-first', action='store_true', dest='failed_first',
+            default=False,
+            help='Run the tests that failed or errored last time first, '
+                 'then everything else.'
+        )
+        parser.add_argument(
+            '--last-failed', action='store_true', dest='last_failed',
+            default=False,
+            help='Only run the tests that failed or errored last time.'
+        )
+        parser.add_argument(
+            '--shard', action='store', dest='shard', default='',
+            help='Only run shard i of n (e.g. --shard=2/4), splitting the '
+                 'tests across n machines by their recorded durations.'
+        )
+        parser.add_argument(
+            '--shard-results', action='store', dest='shard_results',
+            default='',
+            help='Write the results of this run to this file, '
+                 'for --merge-shards later.'
+        )
+        parser.add_argument(
+            '--merge-shards', action='append', dest='merge_shards',
+            default=[],
+            help='Instead of running any tests, print the summary of the '
+                 '--shard-results files (or glob patterns) given.'
+        )
+        parser.add_argument(
+            '--coordinator', action='store', dest='coordinator', default='',
+            help='Instead of running any tests, serve them at host:port to '
+                 '--agent processes on any machine, each pulling more as '
+                 'soon as it is free, and print the summary of them all.'
+        )
+        parser.add_argument(
+            '--agent', action='store', dest='agent', default='',
+            help='Instead of the test_labels given, run the ones pulled from '
+                 'the --coordinator at host:port, until it has no more.'
+        )
+        parser.add_argument(
+            '--slowest', action='store', dest='slowest', default=3, type=int,
+            help='Print this many of the slowest individual tests, '
+                 'with their share of the total time taken by all tests.'
+        )
+        parser.add_argument(
+            '--timings-json', action='store', dest='timings_json',
+            default='',
+            help='Write how long every individual test took to this file.'
+        )
+        parser.add_argument(
+            '--highest-memory', action='store', dest='highest_memory',
+            default=3, type=int,
+            help='Print this many of the test_labels whose process used the '
+                 'most memory running them.'
+        )
+        parser.add_argument(
+            '--memory-json', action='store', dest='memory_json', default='',
+            help='Write the most memory the process running each test_label '
+                 'used to this file.'
+        )
+        parser.add_argument(
+            '--jsonl', action='store', dest='jsonl', default='',
+            help='Write the start and outcome of every individual test to '
+                 'this file as JSON lines, as soon as each happens.'
+        )
+        parser.add_argument(
+            '--junit-xml', action='store', dest='junit_xml', default='',
+            help='Write JUnit XML of every individual test to this file, '
+                 'updated as each test_label finishes.'
+        )
+        parser.add_argument(
+            '--profile', action='store_true', dest='profile', default=False,
+            help='Profile every test_label, storing the stats in '
+                 'LOCAL_CACHE/profile merged per test_label and overall, '
+                 'and print the functions taking the longest.'
+        )
+        parser.add_argument(
+            '--profile-setup', action='store_true', dest='profile_setup',
+            default=False,
+            help='Profile the setup before running any tests, i.e. building '
+                 'the suites and migrating and storing the databases.'
+        )
+        parser.add_argument(
+            '--phase-timings', action='store', dest='phase_timings',
+            default='',
+            help='Write how long each phase of the run took (discovery, '
+                 'migrations, ...) and the overall results to this file.'
+        )
+        parser.add_argument(
+            '--retries', action='store', dest='retries', default=1, type=int,
+            help='How many times to rerun a test_label whose process died '
+                 'part way through it (segfault, out of memory, ...).'
+        )
+        parser.add_argument(
+            '--watch', action='store_true', dest='watch_changes',
+            default=False,
+            help='After running, keep watching the project for changes and '
+                 'rerun the affected test_labels straight away.'
+        )
+        parser.add_argument(
+            '--max-labels-per-worker', action='store',
+            dest='max_labels_per_worker', default=0, type=int,
+            help='Replace each process with a fresh one after it has run '
+                 'this many test_labels (0 for no limit).'
+        )
+        parser.add_argument(
+            '--max-worker-rss', action='store', dest='max_worker_rss',
+            default=0, type=int,
+            help='Replace each process with a fresh one once it is using '
+                 'more than this many MB of memory (0 for no limit).'
+        )
+        parser.add_argument(
+            '--worker-discovery', action='store_true',
+            dest='worker_discovery', default=False,
+            help='Discover the tests of each test_label in the parallel '
+                 'processes, rather than all up front in the parent process.'
+        )
+        parser.add_argument(
+            '--split', action='store', dest='split', default='',
+            choices=SPLIT_CHOICES,
+            help='Split test_labels that take longer than their fair share '
+                 'of the previous run into smaller test module or TestCase '
+                 'class units, so one god app does not hog a single process.'
+        )
     if DJANGO_VERSION[1] < 8:
         option_list = DiscoverRunner.option_list + (
             make_option(
@@ -52,16 +241,179 @@ class DiscoverRoadRunner(DiscoverRunner):
                 action='store', dest='concurrency', default=None,
                 help='Number of additional parallel processes to run. '
                      '--concurrency=0 is thus special - it means run in the '
-                     'same Python process.'),
+                     'same Python process. --concurrency=auto picks (and '
+                     'adjusts) it from the idle cores, available memory and '
+                     'the memory and durations of previous runs.'),
             make_option(
                 '-m', '--ramdb', action='store', dest='ramdb', default='',
                 help='Preserve the :memory:, '
-                     'or RAM test database between runs.')
+                     'or RAM test database between runs.'),
+            make_option(
+                '--ramdb-format', action='store', dest='ramdb_format',
+                default=RAMDB_FORMATS[0],
+                type='choice', choices=RAMDB_FORMATS,
+                help='Store --ramdb databases as a sqlite3 database image '
+                     '(fastest to load) or as a sql text dump.'),
+            make_option(
+                '--file-db', action='store_true', dest='file_db',
+                default=False,
+                help='Give each process its own file backed copy of the '
+                     'stored SQLite databases rather than a :memory: one, '
+                     'cloned copy-on-write where the filesystem supports it.'),
+            make_option(
+                '--coverage', action='store_true', dest='coverage',
+                default=False,
+                help='Measure code coverage in every process, combining it '
+                     'all into one coverage data file at the end.'),
+            make_option(
+                '--changed-since', action='store', dest='changed_since',
+                default='',
+                help='Only run the test_labels affected by changes (committed '
+                     'or not) since this git or hg revision.'),
+            make_option(
+                '--failed-first', action='store_true', dest='failed_first',
+                default=False,
+                help='Run the tests that failed or errored last time first, '
+                     'then everything else.'),
+            make_option(
+                '--last-failed', action='store_true', dest='last_failed',
+                default=False,
+                help='Only run the tests that failed or errored last time.'),
+            make_option(
+                '--shard', action='store', dest='shard', default='',
+                help='Only run shard i of n (e.g. --shard=2/4), splitting the '
+                     'tests across n machines by their recorded durations.'),
+            make_option(
+                '--shard-results', action='store', dest='shard_results',
+                default='',
+                help='Write the results of this run to this file, '
+                     'for --merge-shards later.'),
+            make_option(
+                '--merge-shards', action='append', dest='merge_shards',
+                default=[],
+                help='Instead of running any tests, print the summary of the '
+                     '--shard-results files (or glob patterns) given.'),
+            make_option(
+                '--coordinator', action='store', dest='coordinator',
+                default='',
+                help='Instead of running any tests, serve them at host:port '
+                     'to --agent processes on any machine, each pulling more '
+                     'as soon as it is free, and print the summary of them '
+                     'all.'),
+            make_option(
+                '--agent', action='store', dest='agent', default='',
+                help='Instead of the test_labels given, run the ones pulled '
+                     'from the --coordinator at host:port, until it has no '
+                     'more.'),
+            make_option(
+                '--slowest', action='store', dest='slowest', default=3,
+                type='int',
+                help='Print this many of the slowest individual tests, '
+                     'with their share of the total time taken by all tests.'),
+            make_option(
+                '--timings-json', action='store', dest='timings_json',
+                default='',
+                help='Write how long every individual test took to this '
+                     'file.'),
+            make_option(
+                '--highest-memory', action='store', dest='highest_memory',
+                default=3, type='int',
+                help='Print this many of the test_labels whose process used '
+                     'the most memory running them.'),
+            make_option(
+                '--memory-json', action='store', dest='memory_json',
+                default='',
+                help='Write the most memory the process running each '
+                     'test_label used to this file.'),
+            make_option(
+                '--jsonl', action='store', dest='jsonl', default='',
+                help='Write the start and outcome of every individual test '
+                     'to this file as JSON lines, as soon as each happens.'),
+            make_option(
+                '--junit-xml', action='store', dest='junit_xml', default='',
+                help='Write JUnit XML of every individual test to this file, '
+                     'updated as each test_label finishes.'),
+            make_option(
+                '--profile', action='store_true', dest='profile',
+                default=False,
+                help='Profile every test_label, storing the stats in '
+                     'LOCAL_CACHE/profile merged per test_label and overall, '
+                     'and print the functions taking the longest.'),
+            make_option(
+                '--profile-setup', action='store_true', dest='profile_setup',
+                default=False,
+                help='Profile the setup before running any tests, i.e. '
+                     'building the suites and migrating and storing the '
+                     'databases.'),
+            make_option(
+                '--phase-timings', action='store', dest='phase_timings',
+                default='',
+                help='Write how long each phase of the run took (discovery, '
+                     'migrations, ...) and the overall results to this '
+                     'file.'),
+            make_option(
+                '--retries', action='store', dest='retries', default=1,
+                type='int',
+                help='How many times to rerun a test_label whose process died '
+                     'part way through it (segfault, out of memory, ...).'),
+            make_option(
+                '--watch', action='store_true', dest='watch_changes',
+                default=False,
+                help='After running, keep watching the project for changes '
+                     'and rerun the affected test_labels straight away.'),
+            make_option(
+                '--max-labels-per-worker', action='store',
+                dest='max_labels_per_worker', default=0, type='int',
+                help='Replace each process with a fresh one after it has run '
+                     'this many test_labels (0 for no limit).'),
+            make_option(
+                '--max-worker-rss', action='store', dest='max_worker_rss',
+                default=0, type='int',
+                help='Replace each process with a fresh one once it is using '
+                     'more than this many MB of memory (0 for no limit).'),
+            make_option(
+                '--worker-discovery', action='store_true',
+                dest='worker_discovery', default=False,
+                help='Discover the tests of each test_label in the parallel '
+                     'processes, rather than all up front in the parent '
+                     'process.'),
+            make_option(
+                '--split', action='store', dest='split', default='',
+                type='choice', choices=SPLIT_CHOICES,
+                help='Split test_labels that take longer than their fair '
+                     'share of the previous run into smaller test module or '
+                     'TestCase class units, so one god app does not hog a '
+                     'single process.'),
         )
-    DEFAULT_TAG_HASH = 'default'
+    MIGRATIONS_MANIFEST_NAME = 'migrations.json'
+    LAST_FAILED_FILE_NAME = 'last_failed.json'
+    TIMINGS_FILE_NAME = 'timings.json'
+    MEMORY_FILE_NAME = 'memory.json'
+    # How many of the most recent durations to remember per test_label
+    TIMINGS_HISTORY_LENGTH = 5
+    # Seconds between --watch checks for changed files
+    WATCH_INTERVAL = 0.5
+    # Seconds between --agent heartbeats, and without any before
+    # the --coordinator gives up on that agent
+    HEARTBEAT_INTERVAL = 1
+    AGENT_TIMEOUT = 30
+    # How many of the slowest functions --profile prints,
+    # overall and then for each test_label
+    PROFILE_LENGTH = 20
+    PROFILE_LABEL_LENGTH = 5
+    # --concurrency=auto: seconds of tests worth starting another process
+    # for, how much of the available memory processes may fill, and
+    # seconds between reconsidering how many processes to run
+    AUTO_SECONDS_PER_PROCESS = 1.0
+    AUTO_MEMORY_SHARE = 0.8
+    AUTO_ADJUST_INTERVAL = 5
 
     def __init__(self, *args, **options):
         concurrency = options.get('concurrency', 0)
+        # Worked out in run_tests, once the test_labels are known
+        self.auto_concurrency = concurrency == 'auto'
+        if self.auto_concurrency:
+            concurrency = cpu_count()
         if concurrency is None or int(concurrency) < 0:
             concurrency = cpu_count()
         self.concurrency = int(concurrency)
@@ -76,6 +428,64 @@ class DiscoverRoadRunner(DiscoverRunner):
         except AttributeError:
             save = 'local_cache'
         self.ramdb_saves = os.path.join(os.getcwd(), save)
+        self.ramdb_format = options.get('ramdb_format') or RAMDB_FORMATS[0]
+        self.file_db = options.get('file_db', False)
+        self.baked_fixtures = list(
+            getattr(settings, 'TEST_RUNNER_BAKED_FIXTURES', ()))
+        if self.file_db:
+            # Cloned as is, so it has to be a database image
+            self.ramdb_format = 'sqlite3'
+        self.split = options.get('split', '') or ''
+        self.worker_discovery = options.get('worker_discovery', False)
+        self.watch_changes = options.get('watch_changes', False)
+        self.coverage = options.get('coverage', False)
+        self.changed_since = options.get('changed_since', '') or ''
+        self.failed_first = options.get('failed_first', False)
+        self.last_failed = options.get('last_failed', False)
+        # Tests left out of built suites, as --failed-first runs them already
+        self.exclude_test_ids = set()
+        self.shard = parse_shard(options.get('shard', '') or '')
+        self.shard_results = options.get('shard_results', '') or ''
+        self.merge_shards = options.get('merge_shards') or []
+        self.coordinator = options.get('coordinator', '') or ''
+        self.agent = options.get('agent', '') or ''
+        # host:pid of the --agent process, once it is running
+        self.agent_id = None
+        if self.coordinator:
+            # Only test_labels can be sent to agents, not built suites
+            self.worker_discovery = True
+        slowest = options.get('slowest')
+        self.slowest = 3 if slowest is None else int(slowest)
+        self.timings_json = options.get('timings_json', '') or ''
+        highest_memory = options.get('highest_memory')
+        self.highest_memory = (
+            3 if highest_memory is None else int(highest_memory))
+        self.memory_json = options.get('memory_json', '') or ''
+        self.profile = options.get('profile', False)
+        self.profile_setup = options.get('profile_setup', False)
+        self.phase_timings_json = options.get('phase_timings', '') or ''
+        # {phase: seconds} for --phase-timings
+        self.phase_timings = OrderedDict()
+        self.jsonl = options.get('jsonl', '') or ''
+        self.junit_xml = options.get('junit_xml', '') or ''
+        # The TestEventLog of --jsonl and --junit-xml while running,
+        # and what run_suite passes per-test events to, if anything
+        self.event_log = None
+        self.test_event_callback = None
+        # --agent: whether the --coordinator wants the per-test events
+        self.coordinator_wants_events = False
+        retries = options.get('retries')
+        self.retries = 1 if retries is None else int(retries)
+        self.max_labels_per_worker = int(
+            options.get('max_labels_per_worker') or 0)
+        self.max_worker_rss = int(options.get('max_worker_rss') or 0)
+        self.timings_path = os.path.join(
+            self.ramdb_saves, self.TIMINGS_FILE_NAME)
+        self.last_failed_path = os.path.join(
+            self.ramdb_saves, self.LAST_FAILED_FILE_NAME)
+        self.profile_dir = os.path.join(self.ramdb_saves, 'profile')
+        self.memory_path = os.path.join(
+            self.ramdb_saves, self.MEMORY_FILE_NAME)
         super(DiscoverRoadRunner, self).__init__(*args, **options)
 
     @staticmethod
@@ -89,24 +499,91 @@ class DiscoverRoadRunner(DiscoverRunner):
         is_not_excluded = lambda app: app.__name__ not in excluded_names
         return filter(is_not_excluded, get_apps())
 
+    def build_suite(self, test_labels=None, extra_tests=None, **kwargs):
+        suite = super(DiscoverRoadRunner, self).build_suite(
+            test_labels, extra_tests, **kwargs)
+        # Unless the excluded tests are exactly what was asked for
+        exclude_test_ids = self.exclude_test_ids.difference(test_labels or ())
+        if exclude_test_ids:
+            suite = exclude_tests(suite, exclude_test_ids)
+        return suite
+
     def run_suite(self, suite, **kwargs):
+        send_event = self.test_event_callback
 
         class HijackTextTestResult(unittest.TextTestResult):
 
+            def __init__(self, *args, **kwargs):
+                super(HijackTextTestResult, self).__init__(*args, **kwargs)
+                # [test_id, seconds] of every test run
+                self.test_timings = []
+                self._test_started = None
+                # (outcome, details) of the test running
+                self._outcome = None
+
             @staticmethod
             def repro(test):
                 """
                 String designed to be copied and pasted
                 directly after `manage.py test`.
                 """
-                fast_repro = '.'.join((
-                    test.__module__,
-                    test.__class__.__name__,
-                    # TODO: This sometimes fails / is not present, need to
-                    # TODO: ... remember to investigate when it next happens.
-                    test._testMethodName,
-                ))
-                return colored(fast_repro, 'red')
+                return colored(test_id(test), 'red')
+
+            def startTest(self, test):
+                self._test_started = time.time()
+                self._outcome = ('success', '')
+                super(HijackTextTestResult, self).startTest(test)
+                if send_event is not None:
+                    send_event({
+                        'event': 'start',
+                        'test_id': test_id(test),
+                        'time': self._test_started,
+                    })
+
+            def stopTest(self, test):
+                super(HijackTextTestResult, self).stopTest(test)
+                if self._test_started is not None:
+                    took = time.time() - self._test_started
+                    self.test_timings.append([test_id(test), took])
+                    self._test_started = None
+                    self.send_stop_event(test, took)
+
+            def send_stop_event(self, test, took):
+                if send_event is None:
+                    return
+                outcome, details = self._outcome
+                send_event({
+                    'event': 'stop',
+                    # What setUpClass or the like errored in, if not a test
+                    'test_id': failed_test_id(test),
+                    'time': time.time(),
+                    'took': took,
+                    'outcome': outcome,
+                    'details': details,
+                })
+
+            def set_outcome(self, test, outcome, details=''):
+                self._outcome = (outcome, details)
+                if self._test_started is None:
+                    # e.g. setUpClass, outside of any one test
+                    self.send_stop_event(test, 0.0)
+
+            def addSuccess(self, test):
+                super(HijackTextTestResult, self).addSuccess(test)
+                self.set_outcome(test, 'success')
+
+            def addSkip(self, test, reason):
+                super(HijackTextTestResult, self).addSkip(test, reason)
+                self.set_outcome(test, 'skipped', reason)
+
+            def addExpectedFailure(self, test, err):
+                super(HijackTextTestResult, self).addExpectedFailure(
+                    test, err)
+                self.set_outcome(test, 'expected_failure')
+
+            def addUnexpectedSuccess(self, test):
+                super(HijackTextTestResult, self).addUnexpectedSuccess(test)
+                self.set_outcome(test, 'unexpected_success')
 
             def addError(self, test, err):
                 super(HijackTextTestResult, self).addError(test, err)
@@ -114,6 +591,7 @@ class DiscoverRoadRunner(DiscoverRunner):
                 error_str = self._exc_info_to_string(err, test)
                 write('\n%s %s' % ('ERROR:', self.repro(test)))
                 write('\n%s' % error_str)
+                self.set_outcome(test, 'error', error_str)
 
             def addFailure(self, test, err):
                 super(HijackTextTestResult, self).addFailure(test, err)
@@ -121,6 +599,7 @@ class DiscoverRoadRunner(DiscoverRunner):
                 error_str = self._exc_info_to_string(err, test)
                 write('\n%s %s' % ('FAIL:', self.repro(test)))
                 write('\n%s' % error_str)
+                self.set_outcome(test, 'failure', error_str)
 
         class HijackMoreOutputTestRunner(unittest.TextTestRunner):
             resultclass = HijackTextTestResult
@@ -155,38 +634,240 @@ class DiscoverRoadRunner(DiscoverRunner):
             failfast=self.failfast,
         ).run(suite)
 
+    @staticmethod
+    def get_changed_files(rev):
+        """
+        Absolute paths of the files changed since rev, including uncommitted
+        changes and new files, or None if git or hg can't tell.
+        """
+        # Try git
+        root = source_control_output(['git', 'rev-parse', '--show-toplevel'])
+        if root is not None:
+            changed = source_control_output(
+                ['git', 'diff', '--name-only', rev, '--'])
+            untracked = source_control_output(
+                ['git', 'ls-files', '--others', '--exclude-standard',
+                 '--full-name'])
+            if changed is None or untracked is None:
+                return None
+            paths = (changed + untracked).splitlines()
+            return [os.path.join(root.strip(), path) for path in paths]
+
+        # Try hg
+        root = source_control_output(['hg', 'root'])
+        if root is not None:
+            changed = source_control_output(
+                ['hg', 'status', '--no-status', '--rev', rev])
+            if changed is None:
+                return None
+            return [
+                os.path.join(root.strip(), path)
+                for path in changed.splitlines()
+            ]
+
+        return None
+
+    def filter_changed(self, test_labels):
+        """
+        Only the test_labels that import, directly or indirectly, a file
+        changed since --changed-since, or contain a changed file.
+        """
+        changed_files = self.get_changed_files(self.changed_since)
+        if changed_files is None:
+            print('Could not get the changes since {} from git or hg, '
+                  'running everything'.format(self.changed_since))
+            return test_labels
+        root = os.getcwd()
+        settings_module = getattr(settings, 'SETTINGS_MODULE', None)
+        if settings_module in [
+                module_name(root, path) for path in changed_files]:
+            print('Settings changed, running everything')
+            return test_labels
+        affected = affected_labels(
+            test_labels, changed_files, root, exclude_dirs=[self.ramdb_saves])
+        print('Running {} of {} test_labels affected by changes since {}'
+              .format(len(affected), len(test_labels), self.changed_since))
+        return affected
+
+    @staticmethod
+    def get_schema_files():
+        """
+        Source files that decide what the migrated test databases look like,
+        i.e. the models and migrations of every app (including any
+        in ``TEST_RUNNER_EXCLUDE_APPS``, as they still get migrated).
+        """
+        migration_modules = getattr(settings, 'MIGRATION_MODULES', {})
+        schema_dirs = []
+        schema_files = []
+        for app in get_apps():
+            models_file = os.path.splitext(app.__file__)[0] + '.py'
+            if os.path.basename(models_file) == '__init__.py':
+                # models is a package
+                schema_dirs.append(os.path.dirname(models_file))
+                app_dir = os.path.dirname(os.path.dirname(models_file))
+            else:
+                schema_files.append(models_file)
+                app_dir = os.path.dirname(models_file)
+            app_label = app.__name__.split('.')[-2]
+            if app_label in migration_modules:
+                try:
+                    migrations = importlib.import_module(
+                        migration_modules[app_label])
+                except ImportError:
+                    continue
+                schema_dirs.append(os.path.dirname(migrations.__file__))
+            else:
+                schema_dirs.append(os.path.join(app_dir, 'migrations'))
+        # Loaded into the stored databases too
+        schema_files.extend(find_fixture_files(
+            getattr(settings, 'TEST_RUNNER_BAKED_FIXTURES', ())))
+        for schema_dir in schema_dirs:
+            if not os.path.isdir(schema_dir):
+                continue
+            schema_files.extend(
+                os.path.join(schema_dir, name)
+                for name in os.listdir(schema_dir)
+                if name.endswith('.py')
+            )
+        return sorted(set(schema_files))
+
     @classmethod
-    def get_source_control_tag_hash(cls):
-        try:
-            # Try git
-            out = subprocess.Popen(
-                ['git', 'describe', '--always'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+    def get_schema_hash(cls):
+        """
+        Content hash of the migrations, models and DATABASES settings,
+        so a stored --ramdb database is reused for as long as the schema it
+        was migrated to stays the same, no matter what else gets committed.
+        Must be called before the test databases replace the DATABASES NAMEs.
+        """
+        schema_hash = hash_files(cls.get_schema_files())
+        if DJANGO_VERSION[1] < 7:
+            return schema_hash
+        # get_apps() skips apps without a models module, but their
+        # migrations (e.g. data migrations) still get applied
+        digest = hashlib.sha1(schema_hash.encode('utf8'))
+        digest.update(json.dumps(
+            get_migration_hashes(get_migration_loader()), sort_keys=True,
+        ).encode('utf8'))
+        return digest.hexdigest()[:12]
+
+    @staticmethod
+    def get_base_hash(unmigrated_apps):
+        """
+        Content hash of what, other than migrations, decides what migrated
+        test databases look like, i.e. DATABASES, the models of apps
+        without migrations (which are created straight from their models)
+        and the ``TEST_RUNNER_BAKED_FIXTURES`` loaded into them.
+        """
+        models_files = []
+        for app in get_apps():
+            if app.__name__.split('.')[-2] in unmigrated_apps:
+                models_file = os.path.splitext(app.__file__)[0] + '.py'
+                models_files.append(models_file)
+        fixture_files = find_fixture_files(
+            getattr(settings, 'TEST_RUNNER_BAKED_FIXTURES', ()))
+        return hash_files(sorted(models_files) + fixture_files)
+
+    def find_ancestor_snapshot(self, loader, base_hash):
+        """
+        The stored --ramdb directory with the most migrations applied, where
+        those migrations are still unchanged and all their dependencies are
+        applied too, i.e. a snapshot the current migrations can carry on from.
+        """
+        migration_hashes = get_migration_hashes(loader)
+        best, best_key = None, None
+        if not os.path.isdir(self.ramdb_saves):
+            return None
+        for tag_hash in os.listdir(self.ramdb_saves):
+            tag_dir = os.path.join(self.ramdb_saves, tag_hash)
+            manifest_path = os.path.join(
+                tag_dir, self.MIGRATIONS_MANIFEST_NAME)
+            try:
+                with open(manifest_path) as infile:
+                    manifest = json.load(infile)
+            except (IOError, OSError, ValueError):
+                continue
+            if manifest.get('base') != base_hash:
+                continue
+            if sorted(manifest['applied']) != sorted(settings.DATABASES):
+                continue
+            if not all(
+                    os.path.exists(self.get_db_path(alias, tag_dir))
+                    for alias in settings.DATABASES):
+                continue
+            unchanged = all(
+                migration_hashes.get(key) == file_hash
+                for key, file_hash in manifest['migrations'].items()
             )
-            tag_hash = out.communicate()[0]
-            return tag_hash.decode('utf8').strip()
-        except OSError:
-            pass
+            if not unchanged:
+                continue
+            closed = True
+            for applied in manifest['applied'].values():
+                applied = set(tuple(node) for node in applied)
+                for node in applied:
+                    if '.'.join(node) not in migration_hashes:
+                        # e.g. since deleted, or replaced by a squash
+                        closed = False
+                    elif not applied.issuperset(
+                            loader.graph.forwards_plan(node)):
+                        closed = False
+            if not closed:
+                continue
+            key = (
+                sum(len(a) for a in manifest['applied'].values()),
+                os.path.getmtime(manifest_path),
+            )
+            if best_key is None or key > best_key:
+                best, best_key = tag_dir, key
+        return best
 
-        try:
-            # Try hg
-            # http://stackoverflow.com/questions/6693209/is-there-an-equivalent-to-gits-describe-function-for-mercurial
-            out = subprocess.Popen(
-                ['hg', 'log', '-r' '.' '--template',
-                 "'{latesttag}-{latesttagdistance}-{node|short}\n'"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+    def setup_databases_from(self, ancestor_dir):
+        """
+        Like setup_databases, but starting from a stored --ramdb database
+        and only applying the migrations it is missing.
+        """
+        from django.core.management import call_command
+
+        old_config = hijack_setup_databases(self.verbosity, self.interactive)
+        for database_wrapper in connections.all():
+            # Opens a new, empty :memory: connection
+            database_wrapper.cursor()
+            ancestor = load_pristine_db(
+                self.get_db_path(database_wrapper.alias, ancestor_dir))
+            copy_sqlite_db(ancestor, database_wrapper.connection)
+            ancestor.close()
+            call_command(
+                'migrate',
+                verbosity=max(self.verbosity - 1, 0),
+                interactive=False,
+                database=database_wrapper.alias,
             )
-            tag_hash = out.communicate()[0]
-            return tag_hash.decode('utf8').strip()
-        except OSError:
-            pass
+        return old_config
 
-        return cls.DEFAULT_TAG_HASH
+    def save_migrations_manifest(self, tag_dir, loader, base_hash, applied):
+        """
+        Records which migrations a stored --ramdb database has applied,
+        so later schemas can migrate on from it, see find_ancestor_snapshot.
+        """
+        migration_hashes = get_migration_hashes(loader)
+        applied_keys = set(
+            '.'.join(node) for nodes in applied.values() for node in nodes
+        )
+        manifest = {
+            'base': base_hash,
+            'applied': applied,
+            'migrations': dict(
+                (key, file_hash)
+                for key, file_hash in migration_hashes.items()
+                if key in applied_keys
+            ),
+        }
+        manifest_path = os.path.join(tag_dir, self.MIGRATIONS_MANIFEST_NAME)
+        with open(manifest_path, 'w') as outfile:
+            json.dump(manifest, outfile, indent=2, sort_keys=True)
 
     def get_db_path(self, db_name, tag_hash):
-        return os.path.join(self.ramdb_saves, tag_hash, db_name + '.sql')
+        return os.path.join(
+            self.ramdb_saves, tag_hash, db_name + '.' + self.ramdb_format)
 
     def db_file_paths(self):
         return [
@@ -200,100 +881,655 @@ class DiscoverRoadRunner(DiscoverRunner):
             for db_path in self.db_file_paths()
         )
 
-    def run_tests(self, test_labels, extra_tests=None, **kwargs):
-        extra = 1 if extra_tests else 0
-        start = time.time()
-        if not test_labels:
-            # If no test labels were provided, provide them
-            # and remove our custom exclusions
-            test_labels = [
-                # Don't double-discover tests?
-                app.__name__.replace('.models', '')
-                for app in self.get_apps_after_exclusions()
-            ]
-            # Hide most of the test output so we can focus on failures,
-            # unless the user wanted to see the full output per app.
-            if self.verbosity == 1:
-                self.verbosity = 0
+    def load_timings(self):
+        """
+        Durations of previous runs, keyed by test_label, most recent last.
+        A missing or unreadable history just means no history.
+        """
+        try:
+            with open(self.timings_path) as infile:
+                timings = json.load(infile)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(timings, dict):
+            return {}
+        return timings
+
+    def save_timings(self, timings, results):
+        """
+        Remember how long each test_label took, so the next run can
+        start the slowest test_labels first.
+        """
+        for result in results:
+            history = timings.setdefault(result['test_label'], [])
+            history.append(round(result['took'], 3))
+            del history[:-self.TIMINGS_HISTORY_LENGTH]
+        if not os.path.exists(self.ramdb_saves):
+            os.makedirs(self.ramdb_saves)
+        tmp_path = self.timings_path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(timings, outfile, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.timings_path)
+
+    def record_phase(self, phase, start):
+        """
+        Adds the seconds since start to a phase of --phase-timings.
+        """
+        self.phase_timings[phase] = (
+            self.phase_timings.get(phase, 0) + time.time() - start)
 
-        self.setup_test_environment()
+    def save_phase_timings(self, start, merged):
+        """
+        Writes --phase-timings, along with the overall results, so runs
+        (e.g. against DiscoverRunner) can be compared.
+        """
+        with open(self.phase_timings_json, 'w') as outfile:
+            json.dump({
+                'phases': self.phase_timings,
+                'total': time.time() - start,
+                'results': {
+                    'run': merged['run'],
+                    'failures': merged['fail_count'],
+                    'errors': merged['error_count'],
+                    'skipped': merged['skip_count'],
+                    'expected_failures': merged['expected_fail_count'],
+                    'unexpected_successes':
+                        merged['unexpected_success_count'],
+                    'failed_tests': sorted(merged['failed_tests']),
+                },
+            }, outfile, indent=2)
+
+    def load_memory(self):
+        """
+        The most memory (bytes) a process used in each of the previous runs,
+        most recent last.
+        """
+        try:
+            with open(self.memory_path) as infile:
+                memory = json.load(infile)
+        except (IOError, OSError, ValueError):
+            return []
+        if not isinstance(memory, list):
+            return []
+        return memory
+
+    def save_memory(self, memory, rss):
+        """
+        Remember the most memory a process used, for --concurrency=auto.
+        """
+        memory.append(rss)
+        del memory[:-self.TIMINGS_HISTORY_LENGTH]
+        if not os.path.exists(self.ramdb_saves):
+            os.makedirs(self.ramdb_saves)
+        tmp_path = self.memory_path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(memory, outfile)
+        os.rename(tmp_path, self.memory_path)
+
+    def choose_concurrency(self, test_labels, timings):
+        """
+        --concurrency=auto: as many processes as there are idle cores, that
+        fit in the available memory going by the most a process used in
+        recent runs, and that the test_labels can keep busy going by how
+        long they took in recent runs.
+        """
+        limits = OrderedDict()
+        limits['cores'] = cpu_count()
+        limits['idle cores'] = max(1, int(round(cpu_count() - get_load())))
+        available = get_available_memory()
+        rss = max(self.load_memory() or [0])
+        if available and rss:
+            limits['memory'] = max(
+                1, int(available * self.AUTO_MEMORY_SHARE / rss))
+        durations = [
+            estimate_duration(timings, test_label)
+            for test_label in test_labels
+        ]
+        if durations and None not in durations:
+            total = sum(durations)
+            limits['work'] = max(
+                1, int(total / self.AUTO_SECONDS_PER_PROCESS))
+            if not self.split:
+                # No sooner than the slowest test_label finishes anyway
+                limits['slowest'] = max(1, int(
+                    math.ceil(total / max(max(durations), 0.001))))
+        if test_labels and not self.split:
+            limits['test_labels'] = len(test_labels)
+        concurrency = min(limits.values())
+        print('--concurrency=auto: {} processes ({})'.format(
+            concurrency, ', '.join(
+                '{}={}'.format(name, limit) for name, limit in limits.items()
+            )))
+        return concurrency
+
+    def adjust_concurrency(self, running, rss):
+        """
+        --concurrency=auto, during the run: one fewer process when there's no
+        longer the memory for another like the biggest so far, or one more
+        when there are idle cores and the memory for it.
+        """
+        available = get_available_memory()
+        concurrency = self.concurrency
+        if available is not None and rss and available < rss:
+            concurrency = max(1, concurrency - 1)
+        elif (running >= concurrency and
+              concurrency < cpu_count() and
+              get_load() < cpu_count() - 1 and
+              (available is None or not rss or
+               available * self.AUTO_MEMORY_SHARE > rss)):
+            concurrency += 1
+        if concurrency != self.concurrency:
+            print('--concurrency=auto: now {} processes'.format(concurrency))
+        return concurrency
+
+    def load_last_failed(self):
+        """
+        Test ids (as copied and pasted after `manage.py test`)
+        that failed or errored when they last ran.
+        """
+        try:
+            with open(self.last_failed_path) as infile:
+                last_failed = json.load(infile)
+        except (IOError, OSError, ValueError):
+            return []
+        if not isinstance(last_failed, list):
+            return []
+        return last_failed
+
+    def save_last_failed(self, last_failed, merged):
+        """
+        Forgets the tests that have now run, except those that failed
+        or errored again, adding any newly failing tests.
+        """
+        ran = set()
+        for ran_id, took in merged['test_timings']:
+            parts = ran_id.split('.')
+            ran.update(
+                '.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+        failed = merged['failed_tests']
+        still_failed = [
+            failed_id for failed_id in last_failed
+            if failed_id not in ran and failed_id not in failed
+        ]
+        if not os.path.exists(self.ramdb_saves):
+            os.makedirs(self.ramdb_saves)
+        with open(self.last_failed_path, 'w') as outfile:
+            json.dump(still_failed + sorted(set(failed)), outfile, indent=2)
 
-        # Prepare (often many) test suites to be run across multiple processes
-        # suite = self.build_suite(test_labels, extra_tests)
-        processes = []
-        source_queue = Queue(maxsize=len(test_labels) + extra)
+    def run_in_processes(self, queued, db_files):
+        """
+        Runs each of the queued (unit_label: suite) across --concurrency
+        processes, collecting each result as soon as it arrives.
+        A process that dies part way through a unit_label is replaced,
+        and the unit_label requeued up to --retries times.
+        """
+        source_queue = Queue()
+        result_queue = Queue()
+        for unit_label, suite in queued.items():
+            source_queue.put((unit_label, suite))
+        process_args = (self, source_queue, result_queue, db_files)
 
+        results = []
+        if not self.concurrency:
+            # Concurrency == 0 - run in same process
+            multi_proc_run_tests(*process_args)
+            while len(results) < len(queued):
+                try:
+                    kind, worker_id, unit_label, payload = result_queue.get(
+                        timeout=1)
+                except queue.Empty:
+                    break
+                self.log_message(kind, payload)
+                if kind == 'result':
+                    results.append(payload)
+            if self.file_db:
+                remove_cloned_sqlite_files(db_files, [os.getpid()])
+            return results
+
+        processes = {}
+        # Every process started, to only clean up after this run's own
+        started_pids = []
+
+        def start_process():
+            p = Process(target=multi_proc_run_tests, args=process_args)
+            p.start()
+            processes[p.pid] = p
+            started_pids.append(p.pid)
+
+        outstanding = set(queued)
+        in_flight = {}
+        attempts = {}
+        # Replacement processes started since the last message arrived.
+        # Stops waiting forever on a unit_label whose process died so fast
+        # it never even said it had started.
+        fruitless_starts = 0
+        next_adjustment = time.time() + self.AUTO_ADJUST_INTERVAL
+        for _ in range(min(self.concurrency, len(queued))):
+            start_process()
+
+        while outstanding:
+            try:
+                kind, worker_id, unit_label, payload = result_queue.get(
+                    timeout=0.1)
+            except queue.Empty:
+                pass
+            else:
+                fruitless_starts = 0
+                self.log_message(kind, payload)
+                if kind == 'start':
+                    in_flight[worker_id] = unit_label
+                elif kind == 'result':
+                    in_flight.pop(worker_id, None)
+                    if unit_label in outstanding:
+                        outstanding.discard(unit_label)
+                        results.append(payload)
+                # Keep reading while results are arriving
+                continue
+
+            dead = [p for p in processes.values() if not p.is_alive()]
+            for p in dead:
+                p.join()
+                del processes[p.pid]
+                unit_label = in_flight.pop(get_worker_id(p.pid), None)
+                if unit_label is None:
+                    # Finished normally, nothing left in the source_queue
+                    continue
+                reason = 'Process died (exit code {})'.format(p.exitcode)
+                if self.retry(unit_label, attempts, reason):
+                    source_queue.put((unit_label, queued[unit_label]))
+                else:
+                    outstanding.discard(unit_label)
+
+            if self.auto_concurrency and time.time() > next_adjustment:
+                # Fewer only takes effect as processes exit, e.g. with
+                # --max-labels-per-worker, as they aren't replaced past it
+                next_adjustment = time.time() + self.AUTO_ADJUST_INTERVAL
+                self.concurrency = self.adjust_concurrency(
+                    len(processes),
+                    max([r.get('rss') or 0 for r in results] + [0]))
+
+            # Replace dead processes while there's still work waiting
+            waiting = len(outstanding) - len(in_flight)
+            if not processes and fruitless_starts > self.retries + 1:
+                # Lost track of them, reported as not returning results
+                break
+            while len(processes) < min(self.concurrency, waiting):
+                start_process()
+                fruitless_starts += 1
+
+        for p in processes.values():
+            p.join()
+        if self.file_db:
+            # Of any processes that died
+            remove_cloned_sqlite_files(db_files, started_pids)
+        return results
+
+    def log_message(self, kind, payload):
+        """
+        Passes on the messages from processes that --jsonl and --junit-xml
+        are written from, as they arrive.
+        """
+        if self.event_log is None:
+            return
+        if kind == 'test':
+            self.event_log.add(payload)
+        elif kind == 'result':
+            # A whole test_label more
+            self.event_log.save_junit_xml()
+
+    def retry(self, unit_label, attempts, reason):
+        """
+        Whether to requeue a unit_label lost part way through,
+        up to --retries times, saying which either way.
+        """
+        attempts[unit_label] = attempts.get(unit_label, 0) + 1
+        if attempts[unit_label] <= self.retries:
+            print(colored('{} running {}, requeueing it ({}/{})'.format(
+                reason, unit_label, attempts[unit_label], self.retries),
+                'red'))
+            return True
+        print(colored('{} running {}, giving up on it'.format(
+            reason, unit_label), 'red'))
+        return False
+
+    def coordinate(self, queued):
+        """
+        --coordinator: serves the queued unit_labels to --agent processes,
+        which pull another whenever one is free, so no machine sits idle
+        while another still has a backlog. The unit_labels of an agent
+        that stops sending heartbeats are requeued up to --retries times.
+        """
+        if 'extra_tests' in queued:
+            print('extra_tests can not be sent to agents, skipping them')
+        unit_labels = [
+            unit_label for unit_label in queued if unit_label != 'extra_tests'
+        ]
+        source_queue, result_queue, finished = serve_queues(
+            parse_address(self.coordinator), get_authkey(),
+            wants_events=self.event_log is not None)
+        for unit_label in unit_labels:
+            source_queue.put((unit_label, None))
+        print('Serving {} test units to --agent={}'.format(
+            len(unit_labels), self.coordinator))
+
+        results = []
+        outstanding = set(unit_labels)
+        in_flight = {}
+        # The agent_id each worker_id belongs to, and when each agent
+        # was last heard from
+        worker_agents = {}
+        last_seen = {}
+        attempts = {}
+        while outstanding:
+            try:
+                kind, worker_id, unit_label, payload = result_queue.get(
+                    timeout=self.HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                pass
+            else:
+                self.log_message(kind, payload)
+                if kind == 'heartbeat':
+                    if worker_id not in last_seen:
+                        print('Agent {} connected'.format(worker_id))
+                    last_seen[worker_id] = time.time()
+                elif kind == 'start':
+                    in_flight[worker_id] = unit_label
+                    worker_agents[worker_id] = payload
+                elif kind == 'result':
+                    in_flight.pop(worker_id, None)
+                    if unit_label in outstanding:
+                        outstanding.discard(unit_label)
+                        results.append(payload)
+                elif kind == 'died':
+                    unit_label = in_flight.pop(worker_id, None)
+                    reason = 'Process {} died (exit code {})'.format(
+                        worker_id, payload)
+                    if unit_label is None:
+                        pass
+                    elif self.retry(unit_label, attempts, reason):
+                        source_queue.put((unit_label, None))
+                    else:
+                        outstanding.discard(unit_label)
+
+            now = time.time()
+            for agent_id, seen in list(last_seen.items()):
+                if now - seen < self.AGENT_TIMEOUT:
+                    continue
+                print(colored('Agent {} stopped sending heartbeats'.format(
+                    agent_id), 'red'))
+                del last_seen[agent_id]
+                for worker_id in list(in_flight):
+                    if worker_agents.get(worker_id) != agent_id:
+                        continue
+                    unit_label = in_flight.pop(worker_id)
+                    reason = 'Agent {} disconnected'.format(agent_id)
+                    if self.retry(unit_label, attempts, reason):
+                        source_queue.put((unit_label, None))
+                    else:
+                        outstanding.discard(unit_label)
+
+        finished.set()
+        # Long enough for every agent to notice, before the server goes
+        time.sleep(self.HEARTBEAT_INTERVAL * 2)
+        return results
+
+    def run_agent(self):
+        """
+        --agent: runs the unit_labels pulled from a --coordinator in
+        --concurrency processes, each pulling another as soon as it has
+        finished one, sending heartbeats until the coordinator is finished.
+        """
+        address = parse_address(self.agent)
+        authkey = get_authkey()
+        source_queue, result_queue, finished, events_wanted = connect_queues(
+            address, authkey)
+        # Asked once, rather than sending every event to the coordinator
+        self.coordinator_wants_events = events_wanted.is_set()
+        # Can't tell which test_labels will be pulled, so assume a database
+        db_files = self.setup_ramdb(True)
+        if self.profile:
+            self.clear_profiles()
+        if not self.file_db:
+            # Forked processes copy these, rather than each loading the files
+            preload_pristine_dbs(db_files)
+        self.agent_id = get_worker_id(os.getpid())
+        if self.auto_concurrency:
+            self.concurrency = self.choose_concurrency([], {})
+        # Not in this process, which has to keep sending heartbeats
+        concurrency = max(self.concurrency, 1)
+        print('Agent {} running tests from --coordinator={}'.format(
+            self.agent_id, self.agent))
+
+        processes = {}
+        started_pids = []
+        try:
+            while not finished.is_set():
+                result_queue.put(('heartbeat', self.agent_id, None, None))
+                dead = [p for p in processes.values() if not p.is_alive()]
+                for p in dead:
+                    p.join()
+                    del processes[p.pid]
+                    if p.exitcode:
+                        # The coordinator knows what it was running
+                        result_queue.put((
+                            'died', get_worker_id(p.pid), None, p.exitcode))
+                # Replaces those that found the source_queue empty too,
+                # as the coordinator may yet requeue something
+                while len(processes) < concurrency:
+                    p = Process(target=agent_run_tests,
+                                args=(self, address, authkey, db_files))
+                    p.start()
+                    processes[p.pid] = p
+                    started_pids.append(p.pid)
+                time.sleep(self.HEARTBEAT_INTERVAL)
+        except (EOFError, IOError, OSError):
+            print(colored('Lost the --coordinator', 'red'))
+        for p in processes.values():
+            p.join()
+        if self.file_db:
+            remove_cloned_sqlite_files(db_files, started_pids)
+        if self.profile:
+            self.report_profiles({})
+
+    def plan_units(self, test_labels, extra_tests, timings, last_failed):
+        """
+        Works out the (unit_label: suite) to put in the source_queue, in
+        order, and the test_label each unit_label rolls up into.
+        """
+        oversized = []
+        if self.split:
+            # With --shard every machine has to split the same test_labels,
+            # whatever its --concurrency, so share them out per shard
+            share_count = (
+                self.shard[1] if self.shard else max(self.concurrency, 1))
+            oversized = find_oversized(test_labels, timings, share_count)
+
+        failed_first = []
+        self.exclude_test_ids = set()
+        if self.last_failed or self.failed_first:
+            matching = [
+                failed_id for failed_id in last_failed
+                if failed_id not in test_labels and
+                any(label_matches(label, failed_id) for label in test_labels)
+            ]
+            if not matching:
+                print('No failures recorded from last time, '
+                      'running everything')
+            elif self.last_failed:
+                print('Running the {} tests that failed last time'
+                      .format(len(matching)))
+                test_labels = matching
+            else:
+                failed_first = matching
+                self.exclude_test_ids = set(matching)
+
+        # Each unit is a (unit_label, suite) which is usually a whole
+        # test_label, but may be part of an oversized test_label.
+        # With --worker-discovery the suite is None, and gets built by
+        # whichever process picks up the unit_label, in parallel.
+        units = []
+        unit_to_label = {}
+        for failed_id in failed_first:
+            unit_to_label[failed_id] = [
+                label for label in test_labels
+                if label_matches(label, failed_id)
+            ][0]
         for label in test_labels:
+            if self.worker_discovery and label not in oversized:
+                units.append((label, None))
+                unit_to_label[label] = label
+                continue
             suite = self.build_suite([label])
-            source_queue.put((label, suite))
-        if extra_tests:
-            source_queue.put(
-                ('extra_tests', self.build_suite(None, extra_tests))
+            if label in oversized:
+                label_units = split_suite(suite, self.split)
+            else:
+                label_units = [(label, suite)]
+            for unit_label, unit_suite in label_units:
+                unit_to_label[unit_label] = label
+                units.append((unit_label, unit_suite))
+
+        # Longest job first, so a slow unit picked up last
+        # does not leave every other process idle while it finishes
+        ordered_unit_labels = order_by_slowest(
+            [unit_label for unit_label, unit_suite in units], timings)
+        unit_suites = dict(units)
+        # --failed-first, each test on its own so they all start first
+        queued = OrderedDict(
+            (failed_id, None if self.worker_discovery
+             else self.build_suite([failed_id]))
+            for failed_id in failed_first
+        )
+        queued.update(
+            (unit_label, unit_suites[unit_label])
+            for unit_label in ordered_unit_labels
+        )
+        if self.shard:
+            shard_index, shard_count = self.shard
+            shards = assign_shards(queued, timings, shard_count)
+            queued = OrderedDict(
+                (unit_label, suite)
+                for unit_label, suite in queued.items()
+                if shards[unit_label] == shard_index - 1
             )
+            unit_to_label = dict(
+                (unit_label, unit_to_label[unit_label])
+                for unit_label in queued
+            )
+            print('Running shard {}/{}: {} of the test units'.format(
+                shard_index, shard_count, len(queued)))
+        if extra_tests and (not self.shard or self.shard[0] == 1):
+            queued['extra_tests'] = self.build_suite(None, extra_tests)
+        return queued, unit_to_label, oversized
 
-        if self.ramdb and self.db_files_exist():
+    def setup_ramdb(self, needs_db):
+        """
+        Makes sure the migrated test databases are stored for --ramdb,
+        migrating them only if they aren't already, and returns their files.
+        """
+        setup_start = time.time()
+        if needs_db and not self.ramdb:
+            # Reuse the stored database automatically unless the schema changed
+            self.ramdb = self.get_schema_hash()
+
+        if not needs_db:
+            print('No test_labels need a database, skipping database setup')
+            return []
+
+        if self.db_files_exist():
             # Have run before, reuse the RAM DB.
-            in_files = self.db_file_paths()
-            print('Reusing database files: \n{}'.format('\n'.join(in_files)))
-            queries = []
-            for in_file_name in in_files:
-                with open(in_file_name) as infile:
-                    queries.append('\n'.join(infile.readlines()))
+            # Each process loads the files itself, see create_cloned_sqlite_db
+            db_files = self.db_file_paths()
+            print('Reusing database files: \n{}'.format('\n'.join(db_files)))
             if DJANGO_VERSION[1] >= 7:
                 hijack_setup_databases(self.verbosity, self.interactive)
             else:
                 self.setup_databases()
+            self.record_phase('migrate', setup_start)
+            return db_files
+
+        start = time.time()
+        loader, ancestor_dir = None, None
+        if DJANGO_VERSION[1] >= 7:
+            loader = get_migration_loader()
+            # Before the test databases replace the DATABASES NAMEs
+            base_hash = self.get_base_hash(loader.unmigrated_apps)
+            ancestor_dir = self.find_ancestor_snapshot(loader, base_hash)
+        tag_hash = os.path.join(self.ramdb_saves, self.ramdb)
+        if not os.path.exists(tag_hash):
+            os.makedirs(tag_hash)
+        # Only run the slow migrations if the schema changed,
+        # or running for first time, and then only the new ones
+        if ancestor_dir:
+            print('Running new migrations on top of --ramdb={}... \n'
+                  'Stored as --ramdb={}, which is reused automatically '
+                  'until the migrations, models or DATABASES change.'
+                  .format(os.path.basename(ancestor_dir), self.ramdb))
+            old_config = self.setup_databases_from(ancestor_dir)
         else:
-            start = time.time()
-            tag_hash = self.get_source_control_tag_hash()
-            if tag_hash == self.DEFAULT_TAG_HASH:
-                print('git or hg source control not found, '
-                      'only most recent migration saved')
             print('Running (often slow) migrations... \n'
-                  'Hint: Use --ramdb={} to reuse the final stored SQL later.'
-                  .format(tag_hash))
-            tag_hash = os.path.join(self.ramdb_saves, tag_hash)
-            if not os.path.exists(tag_hash):
-                os.makedirs(tag_hash)
-            # Only run the slow migrations if --ramdb is not specified,
-            # or running for first time
+                  'Stored as --ramdb={}, which is reused automatically '
+                  'until the migrations, models or DATABASES change.'
+                  .format(self.ramdb))
             old_config = self.setup_databases()
-            queries = []
-            for database_wrapper in connections.all():
-                connection = database_wrapper.connection
-                sql = '\n'.join(line for line in connection.iterdump())
-                queries.append(sql)
-                # Work around :memory: in django/db/backends/sqlite3/base.py
-                BaseDatabaseWrapper.close(database_wrapper)
-                mem, db_name = database_wrapper.creation.test_db_signature()
-                with open(self.get_db_path(db_name, tag_hash), 'w') as outfile:
-                    outfile.write(sql)
-            self.teardown_databases(old_config)
-            msg = 'Setup, migrations, ... completed in {:.3f} seconds'.format(
-                time.time() - start
+        if self.baked_fixtures:
+            from django.core.management import call_command
+
+            # Rather than every TestCase class loading them,
+            # see strip_baked_fixtures
+            print('Loading TEST_RUNNER_BAKED_FIXTURES into the stored '
+                  'database: {}'.format(' '.join(self.baked_fixtures)))
+            call_command(
+                'loaddata',
+                *self.baked_fixtures,
+                verbosity=max(self.verbosity - 1, 0),
+                database=DEFAULT_DB_ALIAS
             )
-            print(msg)
-
-        result_queue = Queue(maxsize=len(test_labels) + extra)
-        process_args = (self, source_queue, result_queue, queries)
-        for _ in range(min(self.concurrency, len(test_labels) + extra)):
-            p = Process(target=multi_proc_run_tests, args=process_args)
-            p.start()
-            processes.append(p)
-        else:
-            # Concurrency == 0 - run in same process
-            multi_proc_run_tests(*process_args)
-
-        for p in processes:
-            p.join()
+        self.record_phase('migrate', setup_start)
+        dump_start = time.time()
+        db_files = []
+        applied = {}
+        for database_wrapper in connections.all():
+            db_file = self.get_db_path(database_wrapper.alias, tag_hash)
+            save_db_file(database_wrapper.connection, db_file)
+            db_files.append(db_file)
+            applied[database_wrapper.alias] = get_applied_migrations(
+                database_wrapper.connection)
+            # Work around :memory: in django/db/backends/sqlite3/base.py
+            BaseDatabaseWrapper.close(database_wrapper)
+        if loader is not None:
+            self.save_migrations_manifest(
+                tag_hash, loader, base_hash, applied)
+        self.record_phase('dump', dump_start)
+        self.teardown_databases(old_config)
+        msg = 'Setup, migrations, ... completed in {:.3f} seconds'.format(
+            time.time() - start
+        )
+        print(msg)
+        return db_files
 
-        results = []
-        retrieved_labels = []
-        while not result_queue.empty():
-            retrieved_label, result = result_queue.get()
-            results.append(result)
-            retrieved_labels.append(retrieved_label)
-        not_covered = set(test_labels) - set(retrieved_labels)
+    def run_planned(self, queued, unit_to_label, oversized, db_files, start,
+                    timings, last_failed):
+        """
+        Runs the planned units and prints the per app summary.
+        """
+        if self.profile:
+            self.clear_profiles()
+        if self.jsonl or self.junit_xml:
+            self.event_log = TestEventLog(self.jsonl, self.junit_xml)
+        run_start = time.time()
+        try:
+            if self.coordinator:
+                unit_results = self.coordinate(queued)
+            else:
+                unit_results = self.run_in_processes(queued, db_files)
+        finally:
+            if self.event_log is not None:
+                self.event_log.close()
+                self.event_log = None
+        self.record_phase('run', run_start)
+        collect_start = time.time()
+        retrieved_labels = [r['test_label'] for r in unit_results]
+        not_covered = set(unit_to_label) - set(retrieved_labels)
         if not_covered:
             msg = (
                 'Tests that did not return results under --concurrency={} '
@@ -302,6 +1538,114 @@ class DiscoverRoadRunner(DiscoverRunner):
                     ' '.join(sorted(not_covered)),
                 ))
             print(msg)
+        if self.shard_results:
+            with open(self.shard_results, 'w') as outfile:
+                json.dump({
+                    'unit_results': unit_results,
+                    'unit_to_label': unit_to_label,
+                    'oversized': oversized,
+                    'not_covered': sorted(not_covered),
+                    'took': time.time() - start,
+                }, outfile)
+        merged = self.report(unit_results, unit_to_label, oversized, start,
+                             timings, last_failed)
+        # Across every process, so can add up to more than the run took
+        self.phase_timings['clone'] = (
+            self.phase_timings.get('clone', 0) + merged['clone_took'])
+        self.record_phase('collect', collect_start)
+        if self.profile:
+            self.report_profiles(unit_to_label)
+        return merged
+
+    def get_profile_path(self, unit_label):
+        """
+        Where this process stores the --profile stats of a unit_label.
+        """
+        return os.path.join(self.profile_dir, 'labels', '{}.{}.prof'.format(
+            unit_label, os.getpid()))
+
+    def clear_profiles(self):
+        """
+        Removes the --profile stats of the last run, leaving
+        the labels directory for this run's processes to store theirs in.
+        """
+        for dir_name in ('labels', 'apps'):
+            profile_dir = os.path.join(self.profile_dir, dir_name)
+            if not os.path.exists(profile_dir):
+                os.makedirs(profile_dir)
+            for path in glob.glob(os.path.join(profile_dir, '*.prof')):
+                os.remove(path)
+
+    def report_profiles(self, unit_to_label):
+        """
+        --profile: merges the stats of every unit_label into one file per
+        test_label and one overall, printing the functions that took the
+        longest (cumulatively) overall, then in each test_label.
+        """
+        label_paths = {}
+        pattern = os.path.join(self.profile_dir, 'labels', '*.prof')
+        for path in sorted(glob.glob(pattern)):
+            # <unit_label>.<pid>.prof
+            unit_label = os.path.basename(path).rsplit('.', 2)[0]
+            test_label = unit_to_label.get(unit_label, unit_label)
+            label_paths.setdefault(test_label, []).append(path)
+        if not label_paths:
+            return
+        label_stats = {}
+        for test_label, paths in label_paths.items():
+            label_stats[test_label] = pstats.Stats(*paths)
+            label_stats[test_label].dump_stats(os.path.join(
+                self.profile_dir, 'apps', test_label + '.prof'))
+        overall = pstats.Stats(*sorted(
+            path for paths in label_paths.values() for path in paths))
+        overall_path = os.path.join(self.profile_dir, 'all.prof')
+        overall.dump_stats(overall_path)
+        print(build_profile_message(
+            'All test_labels', overall, self.PROFILE_LENGTH))
+        for test_label in sorted(
+                label_stats, key=lambda label: -label_stats[label].total_tt):
+            print(build_profile_message(
+                test_label, label_stats[test_label],
+                self.PROFILE_LABEL_LENGTH))
+        print('Profiles merged into {}/apps, and {} overall '
+              '(see python -m pstats)'.format(self.profile_dir, overall_path))
+
+    def merge_shard_results(self):
+        """
+        --merge-shards: the summary of every shard's --shard-results,
+        as if it had all been run in one go.
+        """
+        paths = []
+        for pattern in self.merge_shards:
+            paths.extend(sorted(glob.glob(pattern)) or [pattern])
+        unit_results, unit_to_label, oversized, not_covered = [], {}, [], []
+        took = 0
+        for path in paths:
+            with open(path) as infile:
+                shard = json.load(infile)
+            unit_results.extend(shard['unit_results'])
+            unit_to_label.update(shard['unit_to_label'])
+            oversized.extend(shard['oversized'])
+            not_covered.extend(shard['not_covered'])
+            # The shards ran at the same time
+            took = max(took, shard['took'])
+        print('Merging {} shards: {}'.format(len(paths), ' '.join(paths)))
+        if not_covered:
+            print('Tests that did not return results: {}'.format(
+                ' '.join(sorted(not_covered))))
+        return self.report(unit_results, unit_to_label, oversized,
+                           time.time() - took, self.load_timings(),
+                           self.load_last_failed())
+
+    def report(self, unit_results, unit_to_label, oversized, start, timings,
+               last_failed):
+        """
+        Prints the per app summary, and remembers timings and failures
+        for next time.
+        """
+        # Roll split units back up to their test_label,
+        # so the copy/paste summary is per app as always
+        results = rollup_results(unit_results, unit_to_label)
 
         mars = [
             r['test_label']
@@ -327,16 +1671,7 @@ class DiscoverRoadRunner(DiscoverRunner):
             if mars:
                 print(colored(' '.join(mars), 'red'))
 
-        merged = {
-            'test_label': 'OVERALL',
-            'run': sum([r['run'] for r in results]),
-            'fail_count': sum([r['fail_count'] for r in results]),
-            'error_count': sum([r['error_count'] for r in results]),
-            'skip_count': sum([r['skip_count'] for r in results]),
-            'expected_fail_count': sum([r['expected_fail_count'] for r in results]),
-            'unexpected_success_count': sum([r['unexpected_success_count'] for r in results]),
-        }
-        merged['short_summary'] = build_short_summary(merged)
+        merged = merge_extra_msg_dicts('OVERALL', results)
         end = time.time()
         merged['took'] = end - start
 
@@ -347,7 +1682,564 @@ class DiscoverRoadRunner(DiscoverRunner):
         ))
         msg = colored(final_result, color=get_colour(merged), attrs=['bold'])
         print(msg)
+        if self.slowest:
+            print(build_slowest_message(merged['test_timings'], self.slowest))
+        if self.highest_memory and merged['rss']:
+            print(build_memory_message(results, self.highest_memory))
+        if self.timings_json:
+            save_test_timings(merged['test_timings'], self.timings_json)
+        if self.memory_json:
+            save_memory(results, self.memory_json)
+        self.save_last_failed(last_failed, merged)
+        split_results = [
+            r for r in results if r['test_label'] in oversized
+        ]
+        self.save_timings(timings, unit_results + split_results)
+        if merged['rss']:
+            self.save_memory(self.load_memory(), merged['rss'])
+        return merged
+
+    def watch(self, test_labels, db_files):
+        """
+        --watch: reruns just the test_labels affected by each change to the
+        project, in processes forked from this one, which has already set up
+        Django, imported the project and loaded the test databases.
+        """
+        root = os.getcwd()
+        exclude_dirs = [self.ramdb_saves]
+        schema_files = set(self.get_schema_files())
+        if DJANGO_VERSION[1] >= 7:
+            # Including those of apps without a models module
+            schema_files.update(
+                get_migration_files(get_migration_loader()).values())
+        if not self.file_db:
+            # Forked processes copy these, rather than each loading the files
+            preload_pristine_dbs(db_files)
+        mtimes = file_mtimes(root, exclude_dirs)
+        print('Watching for changes... (Ctrl+C to stop)')
+        try:
+            while True:
+                time.sleep(self.WATCH_INTERVAL)
+                new_mtimes = file_mtimes(root, exclude_dirs)
+                changed_files = sorted(
+                    path for path in set(mtimes) | set(new_mtimes)
+                    if mtimes.get(path) != new_mtimes.get(path)
+                )
+                mtimes = new_mtimes
+                if not changed_files:
+                    continue
+                if schema_files.intersection(changed_files):
+                    print(colored(
+                        'Models, migrations or baked fixtures changed, '
+                        'restart --watch to set up the test databases again',
+                        'yellow'))
+                changed_labels = affected_labels(
+                    test_labels, changed_files, root, exclude_dirs)
+                forget_modules(changed_files, root, exclude_dirs)
+                if not changed_labels:
+                    continue
+                print('Rerunning {}'.format(' '.join(changed_labels)))
+                start = time.time()
+                timings = self.load_timings()
+                last_failed = self.load_last_failed()
+                queued, unit_to_label, oversized = self.plan_units(
+                    changed_labels, None, timings, last_failed)
+                self.run_planned(
+                    queued, unit_to_label, oversized, db_files, start,
+                    timings, last_failed)
+        except KeyboardInterrupt:
+            pass
+
+    def run_tests(self, test_labels, extra_tests=None, **kwargs):
+        if self.merge_shards:
+            self.merge_shard_results()
+            return
+        if self.agent:
+            self.setup_test_environment()
+            self.run_agent()
+            self.teardown_test_environment()
+            combined = None
+            if self.coverage and get_coverage_class() is not None:
+                combined = combine_coverage()
+            if combined is not None:
+                print('Coverage data of every process combined into {}'
+                      .format(combined))
+            return
+        start = time.time()
+        if not test_labels:
+            # If no test labels were provided, provide them
+            # and remove our custom exclusions
+            test_labels = [
+                # Don't double-discover tests?
+                app.__name__.replace('.models', '')
+                for app in self.get_apps_after_exclusions()
+            ]
+            # Hide most of the test output so we can focus on failures,
+            # unless the user wanted to see the full output per app.
+            if self.verbosity == 1:
+                self.verbosity = 0
+        all_test_labels = test_labels
+        if self.changed_since:
+            test_labels = self.filter_changed(test_labels)
+
+        collector = None
+        if self.coverage:
+            collector = start_coverage()
+            if collector is None:
+                print('coverage is not installed, running without it')
+                self.coverage = False
+
+        self.setup_test_environment()
+
+        setup_profiler = None
+        if self.profile_setup:
+            setup_profiler = cProfile.Profile()
+            setup_profiler.enable()
+
+        # Prepare (often many) test suites to be run across multiple processes
+        # suite = self.build_suite(test_labels, extra_tests)
+        timings = self.load_timings()
+        last_failed = self.load_last_failed()
+        if self.auto_concurrency:
+            self.concurrency = self.choose_concurrency(test_labels, timings)
+        discover_start = time.time()
+        queued, unit_to_label, oversized = self.plan_units(
+            test_labels, extra_tests, timings, last_failed)
+        self.record_phase('discover', discover_start)
+
+        # Only SimpleTestCase(s) or similar - no need for any databases.
+        # Can't tell for suites that haven't been built yet, so assume so.
+        # --watch can't tell what it will need to rerun later either.
+        # --coordinator leaves it to the agents.
+        needs_db = not self.coordinator and (self.watch_changes or any(
+            suite is None or suite_needs_db(suite)
+            for suite in queued.values()
+        ))
+        db_files = self.setup_ramdb(needs_db)
+        if setup_profiler is not None:
+            setup_profiler.disable()
+            if not os.path.exists(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            setup_path = os.path.join(self.profile_dir, 'setup.prof')
+            setup_profiler.dump_stats(setup_path)
+            print(build_profile_message(
+                'Setup', pstats.Stats(setup_path), self.PROFILE_LENGTH))
+
+        merged = self.run_planned(
+            queued, unit_to_label, oversized, db_files, start,
+            timings, last_failed)
+        if self.phase_timings_json:
+            self.save_phase_timings(start, merged)
+        if self.watch_changes:
+            self.watch(all_test_labels, db_files)
         self.teardown_test_environment()
+        if collector is not None:
+            stop_coverage(collector)
+            combined = combine_coverage()
+            if combined is not None:
+                print('Coverage data of every process combined into {}'
+                      .format(combined))
+
+
+def source_control_output(args):
+    """
+    Output of a git or hg command, or None if it failed or isn't installed.
+    """
+    try:
+        out = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError:
+        return None
+    output = out.communicate()[0]
+    if out.returncode:
+        return None
+    return output.decode('utf8')
+
+
+def get_worker_id(pid):
+    """
+    host:pid, unique across every machine of a --coordinator run.
+    """
+    return '{}:{}'.format(socket.gethostname(), pid)
+
+
+def get_authkey():
+    """
+    What --agent processes must share with their --coordinator to connect,
+    ``TEST_RUNNER_AUTHKEY``. Never the SECRET_KEY, which is often committed,
+    as anyone with the authkey can run code on the coordinator and agents.
+    """
+    authkey = getattr(settings, 'TEST_RUNNER_AUTHKEY', '')
+    if not authkey:
+        raise ImproperlyConfigured(
+            'TEST_RUNNER_AUTHKEY must be set to a secret shared by the '
+            '--coordinator and its --agent runs')
+    return authkey.encode('utf-8')
+
+
+def hash_files(paths):
+    """
+    Short content hash of the named files, plus the Django version and
+    DATABASES settings which decide what migrating them ends up with.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr(DJANGO_VERSION).encode('utf8'))
+    digest.update(json.dumps(
+        settings.DATABASES, sort_keys=True, default=repr,
+    ).encode('utf8'))
+    for path in paths:
+        digest.update(path.encode('utf8'))
+        with open(path, 'rb') as infile:
+            digest.update(infile.read())
+    return digest.hexdigest()[:12]
+
+
+def get_migration_loader():
+    # Django 1.7+ only
+    from django.db.migrations.loader import MigrationLoader
+    return MigrationLoader(None)
+
+
+def get_migration_files(loader):
+    """
+    Source file of each migration, keyed by app_label.migration_name
+    """
+    return dict(
+        ('.'.join(node), os.path.splitext(
+            sys.modules[migration.__module__].__file__)[0] + '.py')
+        for node, migration in loader.graph.nodes.items()
+    )
+
+
+def get_migration_hashes(loader):
+    """
+    Content hash of each migration file, keyed by app_label.migration_name
+    """
+    migration_hashes = {}
+    for key, path in get_migration_files(loader).items():
+        with open(path, 'rb') as infile:
+            migration_hashes[key] = hashlib.sha1(infile.read()).hexdigest()
+    return migration_hashes
+
+
+def get_applied_migrations(connection):
+    """
+    [app_label, migration_name] of each migration applied to a sqlite3
+    connection's database, in the order they were applied.
+    """
+    try:
+        rows = connection.execute(
+            'SELECT app, name FROM django_migrations ORDER BY id'
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # No migrations at all, e.g. Django < 1.7
+        return []
+    return [list(row) for row in rows]
+
+
+def iter_tests(suite):
+    """
+    Every individual test in a (possibly nested) suite.
+    """
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for sub_test in iter_tests(test):
+                yield sub_test
+        else:
+            yield test
+
+
+def skip_db_for_simple_tests():
+    """
+    Whether SimpleTestCase(s) and plain unittest.TestCase(s) are trusted not
+    to query the test databases, which Django (before 1.9) doesn't enforce.
+    """
+    return getattr(settings, 'TEST_RUNNER_SKIP_DB_FOR_SIMPLE_TESTS', False)
+
+
+def suite_needs_db(suite):
+    """
+    Whether any test in the suite may use the test databases.
+    """
+    if not skip_db_for_simple_tests():
+        return any(True for _ in iter_tests(suite))
+    return any(
+        isinstance(test, TransactionTestCase) for test in iter_tests(suite)
+    )
+
+
+def split_suite(suite, split):
+    """
+    Breaks a suite into (unit_label, suite) pieces per test module,
+    or per TestCase class. The unit_label is the same dotted path
+    that can be copied and pasted after `manage.py test`.
+    """
+    groups = OrderedDict()
+    for test in iter_tests(suite):
+        unit_label = test.__class__.__module__
+        if split == 'class':
+            unit_label = '.'.join((unit_label, test.__class__.__name__))
+        groups.setdefault(unit_label, type(suite)()).addTest(test)
+    return list(groups.items())
+
+
+def find_oversized(test_labels, timings, processes):
+    """
+    test_labels that took longer last time than the fair share per process
+    (or --shard) of the whole run, i.e. those that would otherwise decide
+    how long the run takes no matter how many processes there are.
+    """
+    durations = dict(
+        (test_label, estimate_duration(timings, test_label))
+        for test_label in test_labels
+    )
+    known = [d for d in durations.values() if d is not None]
+    if not known:
+        return []
+    fair_share = sum(known) / processes
+    return [
+        test_label
+        for test_label in test_labels
+        if durations[test_label] is not None and
+        durations[test_label] > fair_share
+    ]
+
+
+def parse_shard(shard):
+    """
+    '2/4' -> (2, 4), '' -> None
+    """
+    if not shard:
+        return None
+    try:
+        shard_index, shard_count = [int(n) for n in shard.split('/')]
+    except ValueError:
+        shard_index, shard_count = 0, 0
+    if not 1 <= shard_index <= shard_count:
+        raise ValueError(
+            '--shard should be i/n with 1 <= i <= n, not {}'.format(shard))
+    return shard_index, shard_count
+
+
+def assign_shards(unit_labels, timings, shard_count):
+    """
+    {unit_label: shard number from 0} balancing the recorded durations
+    across shards, longest first onto the least loaded shard. Depends only
+    on its arguments, so every machine with the same timings agrees.
+    """
+    durations = dict(
+        (unit_label, estimate_duration(timings, unit_label))
+        for unit_label in unit_labels
+    )
+    known = [d for d in durations.values() if d is not None]
+    # Never timed - assume average
+    default = sum(known) / len(known) if known else 1.0
+    for unit_label, duration in durations.items():
+        if duration is None:
+            durations[unit_label] = default
+    loads = [0.0] * shard_count
+    shards = {}
+    for unit_label in sorted(durations, key=lambda u: (-durations[u], u)):
+        shard = min(range(shard_count), key=lambda i: (loads[i], i))
+        shards[unit_label] = shard
+        loads[shard] += durations[unit_label]
+    return shards
+
+
+def merge_extra_msg_dicts(test_label, results):
+    merged = {
+        'test_label': test_label,
+        'run': sum([r['run'] for r in results]),
+        'fail_count': sum([r['fail_count'] for r in results]),
+        'error_count': sum([r['error_count'] for r in results]),
+        'skip_count': sum([r['skip_count'] for r in results]),
+        'expected_fail_count': sum([r['expected_fail_count'] for r in results]),
+        'unexpected_success_count': sum([r['unexpected_success_count'] for r in results]),
+        'took': sum([r['took'] for r in results]),
+        'test_timings': [t for r in results for t in r['test_timings']],
+        'failed_tests': [t for r in results for t in r['failed_tests']],
+        'clone_took': sum([r.get('clone_took', 0) for r in results]),
+    }
+    # The most memory any process used running one of them
+    measured = [r['rss'] for r in results if r.get('rss')]
+    merged['rss'] = max(measured) if measured else None
+    merged['short_summary'] = build_short_summary(merged)
+    return merged
+
+
+def rollup_results(unit_results, unit_to_label):
+    """
+    Merges the results of split units back into one result per test_label.
+    """
+    grouped = OrderedDict()
+    for result in unit_results:
+        unit_label = result['test_label']
+        test_label = unit_to_label.get(unit_label, unit_label)
+        grouped.setdefault(test_label, []).append(result)
+    return [
+        group[0] if len(group) == 1 and group[0]['test_label'] == test_label
+        else merge_extra_msg_dicts(test_label, group)
+        for test_label, group in grouped.items()
+    ]
+
+
+def estimate_duration(timings, test_label):
+    """
+    Expected duration of a test_label from its history, or None if
+    it has never been timed before.
+    """
+    history = timings.get(test_label)
+    if not history:
+        return None
+    return sum(history) / len(history)
+
+
+def order_by_slowest(test_labels, timings):
+    """
+    Orders test_labels slowest first. Labels without any history come first
+    of all, as for all we know they could be the slowest.
+    """
+    def sort_key(test_label):
+        duration = estimate_duration(timings, test_label)
+        if duration is None:
+            return (0, 0)
+        return (1, -duration)
+    # sorted is stable, so ties keep their original (app) order
+    return sorted(test_labels, key=sort_key)
+
+
+def test_id(test):
+    """
+    Dotted path to an individual test, as used after `manage.py test`.
+    """
+    method_name = getattr(test, '_testMethodName', None)
+    if method_name is None:
+        # e.g. unittest's placeholders for errors outside of any test
+        return test.id()
+    return '.'.join((
+        test.__module__,
+        test.__class__.__name__,
+        method_name,
+    ))
+
+
+def failed_test_id(test):
+    """
+    Like test_id, but errors outside of any test, e.g. in setUpClass, are
+    given the dotted path of what they were in, so they can be rerun too.
+    """
+    if getattr(test, '_testMethodName', None) is None:
+        # e.g. 'setUpClass (app.tests.SomeTest)'
+        match = re.search(r'\((\S+)\)$', str(test))
+        if match:
+            return match.group(1)
+    return test_id(test)
+
+
+def exclude_tests(suite, test_ids):
+    """
+    Copy of the suite without the tests inside any of the test_ids.
+    """
+    filtered = type(suite)()
+    for test in iter_tests(suite):
+        parts = test_id(test).split('.')
+        prefixes = ('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+        if not any(prefix in test_ids for prefix in prefixes):
+            filtered.addTest(test)
+    return filtered
+
+
+def rank_test_timings(test_timings):
+    """
+    (test_id, seconds, share of all tests' time) slowest first.
+    """
+    total = sum(took for _, took in test_timings) or 1.0
+    return [
+        (test, took, took / total)
+        for test, took in sorted(test_timings, key=lambda t: -t[1])
+    ]
+
+
+def build_slowest_message(test_timings, slowest):
+    lines = ['Slowest {} tests:'.format(slowest)]
+    for test, took, share in rank_test_timings(test_timings)[:slowest]:
+        lines.append('{:9.3f}s {:6.1%}  {}'.format(took, share, test))
+    return '\n'.join(lines)
+
+
+def rank_memory(results):
+    """
+    (test_label, the most memory in bytes the process running it used
+    while running it) highest first.
+    """
+    return [
+        (r['test_label'], r['rss'])
+        for r in sorted(
+            (r for r in results if r.get('rss')),
+            key=lambda r: (-r['rss'], r['test_label']))
+    ]
+
+
+def build_memory_message(results, highest):
+    lines = ['Highest memory {} test_labels:'.format(highest)]
+    for test_label, rss in rank_memory(results)[:highest]:
+        lines.append('{:8.1f} MB  {}'.format(rss / MEGABYTE, test_label))
+    return '\n'.join(lines)
+
+
+def build_profile_message(title, stats, length):
+    """
+    The functions in the pstats.Stats that took the longest cumulatively,
+    with how many times each was called, leaving out the test runners.
+    """
+    cwd = os.getcwd()
+    # unittest's and this runner's own functions are all around the tests,
+    # unlike the rest of its package (e.g. the sample apps)
+    unittest_dir = os.path.dirname(os.path.abspath(unittest.__file__))
+    # Without the extension, as __file__ may be the .pyc
+    runner_files = set(
+        os.path.splitext(os.path.abspath(sys.modules[module_name].__file__))[0]
+        for module_name in (
+            __name__, TestEventLog.__module__, serve_queues.__module__)
+    )
+
+    def is_runner(file_name):
+        return (file_name.startswith(unittest_dir + os.sep) or
+                os.path.splitext(file_name)[0] in runner_files)
+
+    ranked = sorted(
+        (item for item in stats.stats.items() if not is_runner(item[0][0])),
+        key=lambda item: item[1][3], reverse=True)
+    lines = ['{} ({:.3f}s profiled), slowest {} functions:'.format(
+        title, stats.total_tt, length)]
+    for function, (_, calls, _, cumulative, _) in ranked[:length]:
+        file_name, line_number, function_name = function
+        if file_name.startswith(cwd + os.sep):
+            file_name = os.path.relpath(file_name, cwd)
+        lines.append('{:9.3f}s {:8} calls  {}:{}({})'.format(
+            cumulative, calls, file_name, line_number, function_name))
+    return '\n'.join(lines)
+
+
+def save_memory(results, path):
+    ranked = [
+        {'test_label': test_label, 'rss_mb': round(rss / MEGABYTE, 1)}
+        for test_label, rss in rank_memory(results)
+    ]
+    with open(path, 'w') as outfile:
+        json.dump(ranked, outfile, indent=2)
+
+
+def save_test_timings(test_timings, path):
+    ranked = [
+        {'test': test, 'took': round(took, 6), 'share': round(share, 6)}
+        for test, took, share in rank_test_timings(test_timings)
+    ]
+    with open(path, 'w') as outfile:
+        json.dump(ranked, outfile, indent=2)
 
 
 def build_short_summary(extra_msg_dict):
@@ -383,6 +2275,11 @@ def extra_msg_dict_from(test_label, result):
         'skip_count': len(result.skipped),
         'expected_fail_count': len(result.expectedFailures),
         'unexpected_success_count': len(result.unexpectedSuccesses),
+        'test_timings': getattr(result, 'test_timings', []),
+        'failed_tests': [
+            failed_test_id(test)
+            for test, err in result.failures + result.errors
+        ],
     }
     extra_msg_dict['short_summary'] = build_short_summary(extra_msg_dict)
     return extra_msg_dict
@@ -410,33 +2307,108 @@ def build_message(extra_msg_dict):
     return msg
 
 
-def multi_proc_run_tests(pickled_self, source_queue, result_queue, queries):
+def multi_proc_run_tests(pickled_self, source_queue, result_queue, db_files):
     """
     This is a version of `DiscoverRunner.run_tests` that is written to be
     run as a single thread, but run in parallel with other test processes.
     It has also been augmented to provide informative breakdowns for each of
     the test_label(s) placed into the source_queue.
     """
+    worker_id = get_worker_id(os.getpid())
+    collector = None
+    if pickled_self.coverage and current_process().name != 'MainProcess':
+        # Its own data file, as processes end without running atexit.
+        # The main process (-c 0) is already measured by run_tests.
+        collector = start_coverage()
+    try:
+        run_queued_tests(pickled_self, source_queue, result_queue, db_files,
+                         worker_id)
+    finally:
+        if collector is not None:
+            stop_coverage(collector)
+        if pickled_self.file_db:
+            for database_wrapper in connections.all():
+                BaseDatabaseWrapper.close(database_wrapper)
+            for db_file in db_files:
+                remove_sqlite_file(get_clone_path(db_file))
+
+
+def agent_run_tests(pickled_self, address, authkey, db_files):
+    """
+    multi_proc_run_tests on the queues of the --coordinator at address.
+    """
+    source_queue, result_queue = connect_queues(address, authkey)[:2]
+    multi_proc_run_tests(pickled_self, source_queue, result_queue, db_files)
+
+
+def run_queued_tests(pickled_self, source_queue, result_queue, db_files,
+                     worker_id):
+    """
+    The loop of multi_proc_run_tests, reporting back to the parent
+    on the result_queue as it goes.
+    """
+    labels_run = 0
     # Get any test apps / labels in the source_queue until it is empty
     while True:
         try:
-            test_label, suite = source_queue.get(block=False)
+            # Not block=False, as the Queue's feeder thread may not have
+            # flushed what was put on it yet, even in this very process
+            test_label, suite = source_queue.get(timeout=0.1)
         except queue.Empty:
             return
+        # So the parent knows what to requeue if this process dies
+        result_queue.put(
+            ('start', worker_id, test_label, pickled_self.agent_id))
 
         # Set up and run the suite, capturing most of the stream output
         # Printing here can't be made atomic cleanly at verbosity >= 2,
         # i.e. without hacks I don't want to do and it's off the default flows
         start = time.time()
+        reset_peak_rss()
+
+        if suite is None:
+            # --worker-discovery
+            suite = pickled_self.build_suite([test_label])
 
         # Can't safely setup_databases until after suites have been built
-        create_cloned_sqlite_db(queries)
+        pickled_self.test_event_callback = build_event_callback(
+            pickled_self, result_queue, worker_id, test_label)
+        needs_db = suite_needs_db(suite)
+        clone_start = time.time()
+        if needs_db and not sqlite_dbs_are_clean():
+            # Only when the last test_label may have left something behind
+            if pickled_self.file_db:
+                create_cloned_sqlite_file(db_files)
+            else:
+                create_cloned_sqlite_db(db_files)
+            mark_sqlite_dbs_clean()
+        clone_took = time.time() - clone_start
+        if needs_db:
+            restore_instead_of_flush(suite, db_files)
+            strip_baked_fixtures(suite, pickled_self.baked_fixtures)
+
+        if needs_db:
+            # Before running, as unittest drops each test from the suite
+            undone_aliases = get_undone_aliases(suite)
+            changes_before = get_sqlite_changes()
 
         stream = getattr(pickled_self, 'stream', sys.stderr)
-        result = pickled_self.run_suite(suite, stream=stream)
+        if pickled_self.profile:
+            profiler = cProfile.Profile()
+            result = profiler.runcall(
+                pickled_self.run_suite, suite, stream=stream)
+            profiler.dump_stats(pickled_self.get_profile_path(test_label))
+        else:
+            result = pickled_self.run_suite(suite, stream=stream)
+        if needs_db and sqlite_dbs_unchanged(changes_before, undone_aliases):
+            # Changed, if at all, only where it's all undone again
+            mark_sqlite_dbs_clean()
 
         # Build the final message
         extra_msg_dict = extra_msg_dict_from(test_label, result)
+        rss = get_rss()
+        extra_msg_dict['rss'] = get_peak_rss()
+        extra_msg_dict['clone_took'] = clone_took
         end = time.time()
         extra_msg_dict['took'] = end - start
         msg = build_message(extra_msg_dict)
@@ -447,24 +2419,499 @@ def multi_proc_run_tests(pickled_self, source_queue, result_queue, queries):
         # i.e. no annoying interleaving of test output should be possible
         print(full_msg)
 
-        result_queue.put((test_label, extra_msg_dict))
+        result_queue.put(('result', worker_id, test_label, extra_msg_dict))
+        if pickled_self.event_log is not None and not pickled_self.concurrency:
+            # --concurrency=0, so only read from the result_queue at the end
+            pickled_self.event_log.save_junit_xml()
+
+        labels_run += 1
+        if not pickled_self.concurrency:
+            # Nothing to replace this process, the main one
+            continue
+        max_labels = pickled_self.max_labels_per_worker
+        max_rss = pickled_self.max_worker_rss * MEGABYTE
+        if max_labels and labels_run >= max_labels:
+            return
+        if max_rss and rss and rss > max_rss:
+            print(colored(
+                'Process {} using {:.1f} MB after {}, replacing it'.format(
+                    worker_id, rss / MEGABYTE, test_label), 'yellow'))
+            return
+
+
+def build_event_callback(pickled_self, result_queue, worker_id, test_label):
+    """
+    What run_suite passes the per-test events of test_label to, if anything
+    wants them, i.e. --jsonl, --junit-xml or a --coordinator with either.
+    """
+    def with_details(event):
+        event.update(test_label=test_label, worker=worker_id)
+        return event
+
+    if pickled_self.event_log is not None and not pickled_self.concurrency:
+        # --concurrency=0, so this is the process writing them
+        return lambda event: pickled_self.event_log.add(with_details(event))
+    if (pickled_self.jsonl or pickled_self.junit_xml or
+            pickled_self.coordinator_wants_events):
+        return lambda event: result_queue.put(
+            ('test', worker_id, test_label, with_details(event)))
+    return None
+
+
+def get_load():
+    """
+    The number of processes running or waiting to, over the last minute,
+    or 0 where that can't be found out.
+    """
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0
+
+
+def get_available_memory():
+    """
+    Bytes of memory that can be used without swapping, or None where that
+    can't be found out (not Linux).
+    """
+    try:
+        with open('/proc/meminfo') as infile:
+            for line in infile:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def get_rss():
+    """
+    Memory this process is using in bytes, or the most it has used where
+    that can't be read (not Linux), or None if neither can.
+    """
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * mmap.PAGESIZE
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return get_peak_rss()
+
+
+def reset_peak_rss():
+    """
+    Starts get_peak_rss over from the memory this process is using now,
+    where that is possible (Linux 4.0+).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def get_peak_rss():
+    """
+    The most memory this process has used in bytes, since the last
+    reset_peak_rss where that worked, else since it started,
+    or None if that can't be found out.
+    """
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on OS X, kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def get_coverage_class():
+    """
+    coverage's Coverage class, or None if coverage isn't installed.
+    """
+    try:
+        import coverage
+    except ImportError:
+        return None
+    # Renamed in coverage 4.0
+    return getattr(coverage, 'Coverage', None) or coverage.coverage
+
+
+def start_coverage():
+    """
+    Starts measuring coverage in this process, into a data file of its own
+    (.coverage.<host>.<pid>.<random>, configured by .coveragerc as usual).
+    """
+    coverage_class = get_coverage_class()
+    if coverage_class is None:
+        return None
+    collector = coverage_class(data_suffix=True, config_file=True)
+    collector.start()
+    return collector
+
+
+def stop_coverage(collector):
+    collector.stop()
+    collector.save()
 
 
-def create_cloned_sqlite_db(queries):
+def combine_coverage():
+    """
+    Combines the data files of every process into the one data file,
+    ready for `coverage report` and friends, or None if there were none.
+    """
+    combined = get_coverage_class()(config_file=True)
+    if not glob.glob(combined.config.data_file + '.*'):
+        return None
+    combined.combine()
+    combined.save()
+    return combined.config.data_file
+
+
+# Pristine copy of each database alias, loaded once per process
+# the first time create_cloned_sqlite_db is called
+_pristine_dbs = {}
+
+# {alias: (sqlite3 connection, its total_changes)} when this process's
+# databases were last known to match the stored ones
+_clean_dbs = {}
+
+
+def copy_sqlite_db(source, target):
+    """
+    Copies the whole of one sqlite3 connection's database into another,
+    page by page where the backup API is available (Python 3.7+).
+    """
+    if hasattr(source, 'backup'):
+        source.backup(target)
+    else:
+        target.executescript('\n'.join(source.iterdump()))
+        target.commit()
+
+
+def save_db_file(connection, db_file):
+    """
+    Stores a whole sqlite3 database as a database image, or as a sql text
+    dump, depending on the extension of the file name.
+    """
+    tmp_file = db_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    if db_file.endswith('.sql'):
+        with open(tmp_file, 'w') as outfile:
+            outfile.write('\n'.join(connection.iterdump()))
+    else:
+        target = sqlite3.connect(tmp_file)
+        copy_sqlite_db(connection, target)
+        target.close()
+    # Never leave a half written database behind to be reused
+    os.rename(tmp_file, db_file)
+
+
+def load_pristine_db(db_file):
+    """
+    Loads a database stored by save_db_file into :memory:
+    """
+    pristine = sqlite3.connect(':memory:')
+    if db_file.endswith('.sql'):
+        with open(db_file) as infile:
+            # executescript, unlike splitting on ;, copes with ; in the data
+            pristine.executescript(infile.read())
+        pristine.commit()
+    elif hasattr(pristine, 'deserialize'):
+        # Python 3.11+ - straight from the mapped file, no SQL parsing at all
+        with open(db_file, 'rb') as infile:
+            image = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pristine.deserialize(image)
+            finally:
+                image.close()
+    else:
+        source = sqlite3.connect(db_file)
+        copy_sqlite_db(source, pristine)
+        source.close()
+    return pristine
+
+
+def preload_pristine_dbs(db_files):
+    """
+    Loads the pristine databases in this process already, so processes
+    forked from it later don't have to.
+    """
+    for db_file, database_wrapper in zip(db_files, connections.all()):
+        if database_wrapper.alias not in _pristine_dbs:
+            _pristine_dbs[database_wrapper.alias] = load_pristine_db(db_file)
+
+
+def forget_modules(changed_files, root, exclude_dirs=()):
+    """
+    Removes changed project modules, and the modules that import them,
+    from sys.modules so they get imported afresh. Models (and migrations)
+    can't be reimported into a running Django, so they stay as they are.
+    """
+    modules = find_modules(root, exclude_dirs)
+    changed_modules = set(
+        module_name(root, path)
+        for path in changed_files
+        if path.endswith('.py')
+    )
+    settings_module = getattr(settings, 'SETTINGS_MODULE', None)
+    for name in dependents(build_import_graph(modules), changed_modules):
+        parts = name.split('.')
+        if 'models' in parts or 'migrations' in parts:
+            continue
+        if name == settings_module:
+            continue
+        module = sys.modules.pop(name, None)
+        # Otherwise `from package import module` finds the old one
+        parent, _, child = name.rpartition('.')
+        if module is not None and parent in sys.modules:
+            if getattr(sys.modules[parent], child, None) is module:
+                delattr(sys.modules[parent], child)
+
+
+def create_cloned_sqlite_db(db_files):
     """
     Magic. Inspired by:
     http://stackoverflow.com/questions/8045602/how-can-i-copy-an-in-memory-sqlite-database-to-another-in-memory-sqlite-database
     http://stackoverflow.com/questions/8242837/django-multiprocessing-and-database-connections
     """
-    for query_list, database_wrapper in zip(queries, connections.all()):
+    for db_file, database_wrapper in zip(db_files, connections.all()):
         # Work around :memory: in django/db/backends/sqlite3/base.py
         BaseDatabaseWrapper.close(database_wrapper)
 
-        cursor = database_wrapper.cursor()
-        for sql in query_list.split(';'):
-            sql += ';'
-            cursor.execute(sql)
-        database_wrapper.connection.commit()
+        # Opens a new, empty :memory: connection
+        database_wrapper.cursor()
+        alias = database_wrapper.alias
+        if alias not in _pristine_dbs:
+            _pristine_dbs[alias] = load_pristine_db(db_file)
+        copy_sqlite_db(_pristine_dbs[alias], database_wrapper.connection)
+
+
+def clone_file(source, target):
+    """
+    Copies source to target, as a copy-on-write reflink where the filesystem
+    supports it (btrfs, XFS, ...), so copies share their unchanged blocks.
+    """
+    with open(source, 'rb') as infile:
+        with open(target, 'wb') as outfile:
+            try:
+                import fcntl
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+                return
+            except (ImportError, IOError, OSError):
+                pass
+            shutil.copyfileobj(infile, outfile, CLONE_CHUNK_SIZE)
+
+
+def get_clone_path(db_file, pid=None):
+    """
+    Where this (or the given) process's own --file-db copy of a stored
+    database goes.
+    """
+    return '{}.worker-{}'.format(db_file, pid or os.getpid())
+
+
+def remove_sqlite_file(path):
+    """
+    Removes a SQLite database file, along with its journal if any.
+    """
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def remove_cloned_sqlite_files(db_files, pids):
+    """
+    Removes the given processes' --file-db copies of the stored databases,
+    leaving those of any other run sharing the LOCAL_CACHE alone.
+    """
+    for db_file in db_files:
+        for pid in pids:
+            remove_sqlite_file(get_clone_path(db_file, pid))
+
+
+def create_cloned_sqlite_file(db_files):
+    """
+    --file-db version of create_cloned_sqlite_db, pointing each database
+    at a fresh clone of its stored file, for this process alone.
+    """
+    for db_file, database_wrapper in zip(db_files, connections.all()):
+        # Work around :memory: in django/db/backends/sqlite3/base.py
+        BaseDatabaseWrapper.close(database_wrapper)
+        clone_path = get_clone_path(db_file)
+        remove_sqlite_file(clone_path)
+        clone_file(db_file, clone_path)
+        # Connects to it the next time it is used
+        database_wrapper.settings_dict['NAME'] = clone_path
+
+
+def get_sqlite_changes():
+    """
+    {alias: (sqlite3 connection, its total_changes)} for this process's
+    databases right now.
+    """
+    changes = {}
+    for database_wrapper in connections.all():
+        database_wrapper.ensure_connection()
+        connection = database_wrapper.connection
+        changes[database_wrapper.alias] = (
+            connection, connection.total_changes)
+    return changes
+
+
+def mark_sqlite_dbs_clean():
+    """
+    Remembers this process's databases match the stored ones right now.
+    """
+    _clean_dbs.clear()
+    _clean_dbs.update(get_sqlite_changes())
+
+
+def sqlite_dbs_unchanged(changes, undone_aliases=()):
+    """
+    Whether nothing has been written (even if rolled back) to this process's
+    databases since the given get_sqlite_changes(), other than to the
+    undone_aliases, which must still be on the same connections though.
+    """
+    for database_wrapper in connections.all():
+        connection, total_changes = changes.get(
+            database_wrapper.alias, (None, None))
+        if database_wrapper.connection is not connection:
+            # Closed, or replaced
+            return False
+        if database_wrapper.alias in undone_aliases:
+            continue
+        if connection.total_changes != total_changes:
+            return False
+    return True
+
+
+def sqlite_dbs_are_clean():
+    """
+    Whether this process's databases still match the stored ones, i.e.
+    nothing has been written (even if rolled back) since they last did.
+    """
+    return bool(_clean_dbs) and sqlite_dbs_unchanged(_clean_dbs)
+
+
+def get_undone_aliases(suite):
+    """
+    The database aliases every test in the suite undoes whatever it does
+    to, i.e. those a TestCase rolls back or restore_instead_of_flush
+    restores: only the default one unless they're all multi_db. Any test
+    may still write to the rest, so they have to be left unchanged.
+    """
+    undone_aliases = set(
+        database_wrapper.alias for database_wrapper in connections.all())
+    for test in iter_tests(suite):
+        if (isinstance(test, TestCase) or
+                '_fixture_teardown' in test.__dict__):
+            if not getattr(test, 'multi_db', False):
+                undone_aliases &= set([DEFAULT_DB_ALIAS])
+        elif isinstance(test, TransactionTestCase):
+            # Flushed, losing the data migrations created
+            return set()
+        elif not skip_db_for_simple_tests():
+            # May have written to them too
+            return set()
+    return undone_aliases
+
+
+def find_fixture_files(fixture_names):
+    """
+    The files loaddata finds for the given fixture names, in FIXTURE_DIRS
+    and the fixtures directory of every app.
+    """
+    fixture_dirs = list(getattr(settings, 'FIXTURE_DIRS', ()))
+    for app in get_apps():
+        app_dir = os.path.dirname(app.__file__)
+        if os.path.basename(app.__file__).startswith('__init__.'):
+            # models is a package
+            app_dir = os.path.dirname(app_dir)
+        fixture_dirs.append(os.path.join(app_dir, 'fixtures'))
+    paths = []
+    for fixture_name in fixture_names:
+        for fixture_dir in fixture_dirs:
+            pattern = os.path.join(fixture_dir, fixture_name)
+            paths.extend(glob.glob(pattern))
+            # Without the extension (and compression) loaddata works out
+            paths.extend(glob.glob(pattern + '.*'))
+    return sorted(set(paths))
+
+
+def strip_baked_fixtures(suite, baked_fixtures):
+    """
+    Leaves ``TEST_RUNNER_BAKED_FIXTURES``, already in the stored databases,
+    out of the fixtures every TestCase class would load again.
+    """
+    if not baked_fixtures:
+        return
+    for test in iter_tests(suite):
+        if not isinstance(test, TestCase) or getattr(test, 'multi_db', False):
+            # Only baked into the default database
+            continue
+        fixtures = getattr(test, 'fixtures', None) or []
+        remaining = [f for f in fixtures if f not in baked_fixtures]
+        if len(remaining) == len(fixtures):
+            continue
+        test_class = type(test)
+        if remaining or DJANGO_VERSION[1] >= 7:
+            test_class.fixtures = remaining
+        elif 'fixtures' in test_class.__dict__ and not hasattr(
+                test_class.__mro__[1], 'fixtures'):
+            # loaddata of no fixtures at all is an error before Django 1.7
+            del test_class.fixtures
+
+
+def restore_sqlite_dbs(db_files, aliases):
+    """
+    Puts the databases of the given aliases back the way they were stored,
+    in place, at roughly the cost of copying them.
+    """
+    for db_file, database_wrapper in zip(db_files, connections.all()):
+        alias = database_wrapper.alias
+        if alias not in aliases:
+            continue
+        database_wrapper.ensure_connection()
+        if alias in _pristine_dbs:
+            copy_sqlite_db(_pristine_dbs[alias], database_wrapper.connection)
+        else:
+            # --file-db, which doesn't load them into memory
+            source = sqlite3.connect(db_file)
+            copy_sqlite_db(source, database_wrapper.connection)
+            source.close()
+
+
+def restore_instead_of_flush(suite, db_files):
+    """
+    Makes each TransactionTestCase (that isn't a TestCase, which rolls back)
+    restore the databases it used afterwards, rather than flushing every
+    table, which is much slower and loses the data migrations created.
+    """
+    if not hasattr(sqlite3.Connection, 'backup'):
+        # The iterdump fallback of copy_sqlite_db can't overwrite
+        return
+    all_aliases = [
+        database_wrapper.alias for database_wrapper in connections.all()
+    ]
+    for test in iter_tests(suite):
+        if not isinstance(test, TransactionTestCase):
+            continue
+        if isinstance(test, TestCase):
+            continue
+        aliases = (
+            all_aliases if getattr(test, 'multi_db', False)
+            else [DEFAULT_DB_ALIAS])
+        # Replaces the flush in TransactionTestCase._post_teardown
+        test._fixture_teardown = functools.partial(
+            restore_sqlite_dbs, db_files, aliases)
 
 
 def hijack_setup_databases(verbosity, interactive, **kwargs):